@@ -7,9 +7,13 @@ Written by Jacob Cook
 Licensed under GPLv3, see LICENSE.md
 """
 
+import atexit
 import eventlet
 import logging
+import os
+import signal
 import ssl
+import sys
 
 from logging.handlers import RotatingFileHandler
 
@@ -18,31 +22,263 @@ from kraken import auth, genesis
 import arkos
 from arkos import logger
 from arkos.utilities import random_string, detect_platform, NotificationFilter
+from arkos.utilities.errors import ConnectionError
 
-from kraken.redis_storage import storage
+from kraken.jobs import scheduler, recover_jobs, job_done, worker_id
+from kraken.jobs import INSTANCE, JOB_EXPIRY
+from kraken.redis_storage import storage, PoolExhaustedError
+from kraken.pubsub import dispatcher
+from kraken.records import push_buffer, deltas
+from kraken.sockets import broadcaster, outbound
+from kraken.sockets import model_room, job_room, binary_room, patch_room
+from kraken.sockets import BROADCAST_ROOM, NOTIFICATIONS_ROOM
 from kraken.logging import APIHandler, FileFormatter, WSGILogWrapper
 from kraken.utilities import add_cors_to_response, make_json_error
 from kraken.framework import register_frameworks
 
 from flask import Flask
-from flask_socketio import SocketIO
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from werkzeug.exceptions import default_exceptions
-import json
 
 app = Flask(__name__)
-socketio = SocketIO(app)
+socketio = SocketIO()
 
+LEADER_TTL = 15
+"""Time in seconds until the lock of the event relaying worker lapses."""
 
-def handle_pubsub(ps, sio):
+
+def push_models(name, records):
+    if not deltas.enabled:
+        broadcaster.push_models(name, records)
+        return
+    full, patches = deltas.split(name, records)
+    broadcaster.push_models(name, records, full, patches)
+
+
+def purge_model(data):
+    push_buffer.discard(data["model"], data["id"])
+    deltas.forget(data["model"], data["id"])
+    broadcaster.purge_model(data)
+
+
+@socketio.on("connect")
+def connect_client(auth=None):
+    join_room(BROADCAST_ROOM)
+
+
+@socketio.on("subscribe")
+def subscribe(data):
+    """
+    Subscribe a client to events for specific object types or jobs.
+
+    Expects ``models`` and ``jobs`` lists, and ``notifications`` set to
+    true to receive all notifications. The client then stops receiving
+    events it did not subscribe to. With ``encoding`` set to ``msgpack``,
+    event data is sent as msgpack bytes if the server supports it. With
+    ``patches`` set to true, records pushed again are sent as
+    ``modelPatch`` events where smaller; the client is first told to
+    resync the subscribed models, as it may have missed earlier pushes.
+
+    :returns: dict with the encoding used for the subscribed events
+    """
+    binary = data.get("encoding") == "msgpack" and broadcaster.binary
+    room = binary_room if binary else (lambda x: x)
+    patches = bool(data.get("patches"))
+    leave_room(BROADCAST_ROOM)
+    for x in data.get("models", []):
+        join_room(room(patch_room(model_room(x)) if patches
+                       else model_room(x)))
+    for x in data.get("jobs", []):
+        join_room(room(job_room(x)))
+    if data.get("notifications"):
+        join_room(room(NOTIFICATIONS_ROOM))
+    if patches and data.get("models"):
+        emit("resync", {"models": sorted(data["models"])})
+    return {"encoding": "msgpack" if binary else "json"}
+
+
+@socketio.on("unsubscribe")
+def unsubscribe(data):
+    """Unsubscribe a client from events, as subscribed to before."""
+    rooms = [model_room(x) for x in data.get("models", [])]
+    rooms += [job_room(x) for x in data.get("jobs", [])]
+    if data.get("notifications"):
+        rooms.append(NOTIFICATIONS_ROOM)
+    rooms += [patch_room(x) for x in rooms if x.startswith("model:")]
+    for x in rooms:
+        leave_room(x)
+        leave_room(binary_room(x))
+
+
+def start_push(config):
+    """Start relaying record pushes to socket.io clients."""
+    deltas.configure(config.get("genesis", "push_deltas", True),
+                     config.get("genesis", "push_delta_cache", 1024))
+    push_buffer.configure(
+        push_models, config.get("genesis", "push_window", 50) / 1000.0)
+    dispatcher.on("records:push", push_buffer.push)
+    dispatcher.on("records:purge", purge_model)
+
+
+def stop_push():
+    """Stop relaying record pushes, sending those already queued."""
+    for x in ["records:push", "records:purge"]:
+        dispatcher.off(x)
+    push_buffer.flush()
+
+
+def elect_leader(config):
+    """
+    Relay record pushes from one worker process at a time.
+
+    Workers compete for a lock in storage. The holder renews it
+    periodically, and another worker takes over if it lapses.
+    """
+    owner, leader = worker_id(), False
     while True:
-        msg = ps.get_message()
-        if msg and msg["channel"] == b"arkos:notifications":
-            sio.emit("sendNotification", json.loads(msg["data"].decode()))
-        elif msg and msg["channel"] == b"arkos:records:push":
-            sio.emit("modelPush", json.loads(msg["data"].decode()))
-        elif msg and msg["channel"] == b"arkos:records:purge":
-            sio.emit("modelPurge", json.loads(msg["data"].decode()))
-        eventlet.sleep(0.1)
+        try:
+            if leader:
+                held = storage.renew_lock("leader", owner, LEADER_TTL)
+            else:
+                held = storage.acquire_lock("leader", owner, LEADER_TTL)
+        except (ConnectionError, PoolExhaustedError):
+            held = False
+        if held and not leader:
+            logger.info("Init", "Worker {0} is relaying pushes".format(owner))
+            start_push(config)
+        elif leader and not held:
+            logger.warning("Init", "Worker {0} lost the relay lock"
+                           .format(owner))
+            stop_push()
+        leader = held
+        eventlet.sleep(LEADER_TTL / 3.0)
+
+
+def serve(config, workers=1, replaces=None):
+    """
+    Serve HTTP and socket.io requests from this process until stopped.
+
+    :param Config config: arkOS configuration
+    :param int workers: Number of worker processes sharing the socket
+    :param str replaces: ID of a dead worker process whose jobs to recover
+    """
+    # Long-polling requests of one session must all reach the same worker,
+    # which SO_REUSEPORT can't ensure; a WebSocket stays on one connection
+    transports = ["websocket"] if workers > 1 else ["polling", "websocket"]
+    socketio.init_app(
+        app, http_compression=config.get("genesis", "compression", True),
+        compression_threshold=config.get(
+            "genesis", "compression_threshold", 1024),
+        transports=transports)
+    scheduler.configure(
+        config.get("genesis", "job_workers", 4),
+        config.get("genesis", "job_limits",
+                   {"packages": 1, "certificates": 2}),
+        config.get("genesis", "job_timeouts", {"certificates": 600}),
+        config.get("genesis", "job_timeout", None))
+    dispatcher.on("jobs:cancel", scheduler.cancel)
+    dispatcher.on("jobs:done", job_done)
+    resume = config.get("genesis", "job_resume", True)
+    # Only the first worker of this daemon to start recovers old jobs
+    if storage.acquire_lock("recovery:{0}".format(INSTANCE), worker_id(),
+                            JOB_EXPIRY):
+        resumed, orphaned = recover_jobs(resume)
+        if resumed or orphaned:
+            logger.info("Init", "Resumed {0} and abandoned {1} interrupted "
+                        "job(s)".format(resumed, orphaned))
+    if replaces:
+        resumed, orphaned = recover_jobs(resume, replaces)
+        if resumed or orphaned:
+            logger.info("Init", "Resumed {0} and abandoned {1} job(s) of "
+                        "worker {2}".format(resumed, orphaned, replaces))
+    outbound.configure(socketio.server,
+                       config.get("genesis", "socket_queue_size", 256),
+                       config.get("genesis", "socket_queue_depth", 16))
+    broadcaster.configure(socketio,
+                          config.get("genesis", "socket_msgpack", True),
+                          relay=workers > 1)
+    dispatcher.on("notifications", broadcaster.send_notification, raw=True)
+    dispatcher.on("jobs:progress", broadcaster.send_progress)
+    if workers > 1:
+        dispatcher.on("sockets:emit", broadcaster.relayed)
+        eventlet.spawn(elect_leader, config)
+    else:
+        start_push(config)
+    storage.watch_keyspace(dispatcher)
+    pubsub = storage.redis.pubsub(ignore_subscribe_messages=True)
+    eventlet.spawn(dispatcher.start, pubsub)
+    eventlet_socket = eventlet.listen(
+        (config.get("genesis", "host"), config.get("genesis", "port")),
+        reuse_port=workers > 1
+    )
+    if config.get("genesis", "ssl", False):
+        eventlet_socket = eventlet.wrap_ssl(
+            eventlet_socket, certfile=config.get("genesis", "cert_file"),
+            keyfile=config.get("genesis", "cert_key"),
+            ssl_version=ssl.PROTOCOL_TLSv1_2, server_side=True)
+    eventlet.wsgi.server(
+        eventlet_socket, app, log=WSGILogWrapper(),
+        log_format=('%(client_ip)s - "%(request_line)s" %(status_code)s '
+                    '%(body_length)s %(wall_seconds).6f'))
+
+
+def prefork(config, workers):
+    """
+    Serve requests from several worker processes, restarting any that die.
+
+    Each worker binds its own listening socket with ``SO_REUSEPORT``, so
+    the kernel spreads connections among them. As consecutive requests of
+    a client may reach different workers, socket.io clients must then
+    connect over WebSocket; long-polling is disabled.
+
+    :param Config config: arkOS configuration
+    :param int workers: Number of worker processes
+    """
+    children = {}
+
+    def stop(signum, frame):
+        sys.exit(0)
+
+    def spawn(number, replaces=None):
+        pid = os.fork()
+        if pid:
+            children[pid] = number
+            return
+        signal.signal(signal.SIGTERM, stop)
+        # Connections and cached values must not be shared with the parent
+        storage.reconnect()
+        try:
+            serve(config, workers, replaces)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        except Exception:
+            logging.getLogger(__name__).exception("Worker failed")
+        finally:
+            try:
+                storage.release_lock("leader", worker_id())
+                # atexit handlers don't run on os._exit(), and each worker
+                # has statistics of its own
+                path = config.get("genesis", "metrics_file", None)
+                if path:
+                    storage.dump_stats("{0}.{1}".format(path, number))
+            finally:
+                os._exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for x in range(workers):
+            spawn(x)
+        while True:
+            pid, status = os.wait()
+            number = children.pop(pid, None)
+            if number is not None:
+                logger.warning("Init", "Worker {0} exited with status {1}, "
+                               "restarting".format(number, status))
+                # The new worker takes over the jobs the old one left
+                spawn(number, worker_id(pid))
+    finally:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
 
 
 def run_daemon(environment, config_file, secrets_file,
@@ -56,6 +292,7 @@ def run_daemon(environment, config_file, secrets_file,
                         app.debug, environment in ["dev", "vagrant"],
                         app.logger)
     storage.connect()
+    atexit.register(storage.dump_stats)
 
     if environment not in ["dev", "vagrant"]:
         filehdlr = RotatingFileHandler(
@@ -107,26 +344,21 @@ def run_daemon(environment, config_file, secrets_file,
                   "access the Web interface.")
         logger.warning("Init", errmsg)
 
+    workers = config.get("genesis", "workers", 1)
+    if workers > 1 and \
+            config.get("genesis", "storage_backend", "redis") == "memory":
+        logger.warning("Init", "The memory storage backend cannot be shared "
+                       "between processes; using a single worker")
+        workers = 1
+
     app.after_request(add_cors_to_response)
     logger.info("Init", "Server is up and ready")
     try:
-        import eventlet
-        pubsub = storage.redis.pubsub(ignore_subscribe_messages=True)
-        pubsub.subscribe(["arkos:notifications", "arkos:records:push",
-                          "arkos:records:purge"])
-        eventlet.spawn(handle_pubsub, pubsub, socketio)
-        eventlet_socket = eventlet.listen(
-            (config.get("genesis", "host"), config.get("genesis", "port"))
-        )
-        if config.get("genesis", "ssl", False):
-            eventlet_socket = eventlet.wrap_ssl(
-                eventlet_socket, certfile=config.get("genesis", "cert_file"),
-                keyfile=config.get("genesis", "cert_key"),
-                ssl_version=ssl.PROTOCOL_TLSv1_2, server_side=True)
-        eventlet.wsgi.server(
-            eventlet_socket, app, log=WSGILogWrapper(),
-            log_format=('%(client_ip)s - "%(request_line)s" %(status_code)s '
-                        '%(body_length)s %(wall_seconds).6f'))
+        if workers > 1:
+            logger.info("Init", "Starting {0} workers".format(workers))
+            prefork(config, workers)
+        else:
+            serve(config)
     except KeyboardInterrupt:
         logger.info("Init", "Received interrupt")
         raise
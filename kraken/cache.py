@@ -0,0 +1,97 @@
+"""
+Classes to manage a bounded in-process cache.
+
+arkOS Kraken
+(c) 2016 CitizenWeb
+Written by Jacob Cook
+Licensed under GPLv3, see LICENSE.md
+"""
+
+import threading
+import time
+
+from collections import OrderedDict
+
+MISSING = object()
+"""Returned by ``LRUCache.get()`` when no cached value exists."""
+
+
+class LRUCache:
+    """
+    A thread-safe cache with least-recently-used eviction and expiry.
+
+    Values are grouped by key, with one or more fields per key, so that
+    every cached view of a key can be invalidated at once.
+    """
+
+    def __init__(self, size, ttl):
+        """
+        Initialize.
+
+        :param int size: Maximum number of keys to hold
+        :param float ttl: Seconds a key is kept before it is refetched
+        """
+        self.size = size
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0,
+                      "expirations": 0, "invalidations": 0}
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, field=None):
+        """
+        Return a cached value.
+
+        :param str key: Key name
+        :param field: Field of the key to fetch
+        :returns: Cached value, or ``MISSING``
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry and entry[0] < time.time():
+                del self._data[key]
+                self.stats["expirations"] += 1
+                entry = None
+            if not entry or field not in entry[1]:
+                self.stats["misses"] += 1
+                return MISSING
+            self._data.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1][field]
+
+    def set(self, key, value, field=None):
+        """
+        Cache a value, evicting the least recently used key if full.
+
+        :param str key: Key name
+        :param value: Value to cache
+        :param field: Field of the key to set
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if not entry:
+                entry = (time.time() + self.ttl, {})
+                self._data[key] = entry
+            entry[1][field] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def invalidate(self, key):
+        """
+        Drop all cached fields for a key.
+
+        :param str key: Key name
+        """
+        with self._lock:
+            if self._data.pop(key, None):
+                self.stats["invalidations"] += 1
+
+    def clear(self):
+        """Drop all cached values."""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
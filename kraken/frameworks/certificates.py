@@ -77,6 +77,7 @@ class CertificatesAPI(MethodView):
 
     def _generate(self, job, data):
         nthread = NotificationThread(id=job.id)
+        job.progress(step=0, steps=2, phase="Generating key")
         try:
             cert = certificates.generate_certificate(
                 data["id"], data["domain"], data["country"], data["state"],
@@ -87,6 +88,7 @@ class CertificatesAPI(MethodView):
             raise
         else:
             push_record("certificate", cert.serialized)
+        job.progress(step=1, phase="Updating authorities")
         try:
             basehost = ".".join(data["domain"].split(".")[-2:])
             ca = certificates.get_authorities(basehost)
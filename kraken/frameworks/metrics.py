@@ -0,0 +1,42 @@
+"""
+Endpoints for retrieval of server performance metrics.
+
+arkOS Kraken
+(c) 2016 CitizenWeb
+Written by Jacob Cook
+Licensed under GPLv3, see LICENSE.md
+"""
+
+from flask import Blueprint, jsonify
+
+from kraken import auth
+from kraken.redis_storage import storage
+from kraken.pubsub import dispatcher
+from kraken.jobs import scheduler
+from kraken.records import push_buffer, deltas
+from kraken.sockets import broadcaster, outbound
+
+backend = Blueprint("metrics", __name__)
+
+
+@backend.route('/api/metrics/storage')
+@auth.required()
+def get_storage():
+    """Endpoint to return storage connection and command statistics."""
+    return jsonify(storage=storage.get_stats())
+
+
+@backend.route('/api/metrics/pubsub')
+@auth.required()
+def get_pubsub():
+    """Endpoint to return publish/subscribe listener statistics."""
+    return jsonify(pubsub=dispatcher.get_stats(), records=push_buffer.stats,
+                   deltas=deltas.stats, rooms=broadcaster.stats,
+                   clients=outbound.get_stats())
+
+
+@backend.route('/api/metrics/jobs')
+@auth.required()
+def get_jobs():
+    """Endpoint to return job scheduler statistics."""
+    return jsonify(jobs=scheduler.get_stats())
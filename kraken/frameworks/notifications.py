@@ -11,10 +11,15 @@ from flask import Blueprint, jsonify, abort, Response, request
 from flask.views import MethodView
 
 from kraken import auth
+from kraken.jobs import scheduler, cancel_job, progress_info
+from kraken.jobs import list_jobs, wait_for_job
 from kraken.redis_storage import storage
 
 from arkos.messages import Notification, NotificationThread
 
+MAX_WAIT = 60
+"""Max time in seconds a request may wait for a job to finish."""
+
 backend = Blueprint("messages", __name__)
 
 
@@ -32,9 +37,10 @@ class NotificationsAPI(MethodView):
                 message = messages[0]
                 message["history"] = []
             return jsonify(notification=message)
-        else:
-            ids = (x.split("arkos:n:")[1] for x in storage.scan("n:*"))
-        messages = (storage.lindex("n:{0}".format(x), 0) for x in ids)
+        messages = []
+        for batch in storage.scan_batches("n:*"):
+            keys = ["n:{0}".format(x.split("arkos:n:")[1]) for x in batch]
+            messages += [x for x in storage.lindex_all(keys) if x]
         return jsonify(notifications=sorted(messages, key=lambda x: x["time"]))
 
     @auth.required()
@@ -66,34 +72,92 @@ class NotificationsAPI(MethodView):
                 abort(404)
             storage.delete("n:{0}".format(id))
         else:
-            for x in storage.scan("n:*"):
-                storage.delete("n:{0}".format(x.split("arkos:n:")[1]))
+            for batch in storage.scan_batches("n:*"):
+                pipe = storage.pipeline()
+                for x in batch:
+                    storage.delete(
+                        "n:{0}".format(x.split("arkos:n:")[1]), pipe=pipe)
+                storage.execute(pipe)
         return Response(status=204)
 
 
 @backend.route('/api/jobs')
 @auth.required()
 def get_jobs():
-    """Endpoint to return a list of all pending jobs."""
-    jobs = []
-    for x in storage.scan("job"):
-        jobs.append("/api/jobs/{0}".format(x.split("arkos:job:")[1]))
-    return jsonify(jobs=jobs)
+    """
+    Endpoint to return a page of jobs, newest first.
+
+    Accepts ``status``, ``type``, ``since`` and ``limit`` parameters, and
+    the ``cursor`` returned with the previous page.
+    """
+    try:
+        since = request.args.get("since", None, type=float)
+        cursor = request.args.get("cursor", None, type=float)
+        limit = min(max(int(request.args.get("limit", 50)), 1), 500)
+    except ValueError:
+        abort(400)
+    details, cursor = list_jobs(
+        request.args.get("status"), request.args.get("type"), since, cursor,
+        limit)
+    jobs = ["/api/jobs/{0}".format(x["id"]) for x in details]
+    return jsonify(jobs=jobs, details=details, cursor=cursor)
+
+
+def _read_job(id):
+    # Status, notification head and descriptor in one round trip
+    pipe = storage.pipeline()
+    storage.get("job:{0}".format(id), pipe=pipe)
+    storage.lindex("n:{0}".format(id), 0, pipe=pipe)
+    storage.get_all("jobs:{0}".format(id), pipe=pipe)
+    return storage.execute(pipe)
 
 
 @backend.route('/api/jobs/<string:id>')
 @auth.required()
 def get_job(id):
-    """Endpoint to return information about a specific job."""
-    data = {}
-    job = storage.get("job:{0}".format(id))
+    """
+    Endpoint to return information about a specific job.
+
+    With a ``wait`` parameter, waits up to that many seconds for the job
+    to finish before responding.
+    """
+    try:
+        wait = min(float(request.args.get("wait", 0)), MAX_WAIT)
+    except ValueError:
+        abort(400)
+    job, data, info = _read_job(id)
     if not job:
         abort(404)
-    if storage.exists("n:{0}".format(id)):
-        data = storage.lindex("n:{0}".format(id), 0)
+    if wait > 0 and int(job) == 200:
+        if wait_for_job(id, wait) not in (None, 200):
+            job, data, info = _read_job(id)
+    data = dict(data or {})
+    position = scheduler.position(id)
+    if position is not None:
+        data["position"] = position
+    if info:
+        data["job"] = {x: y for x, y in info.items()
+                       if x not in ["args", "kwargs", "instance", "worker"]}
+        if info.get("progress"):
+            data["job"]["progress"] = progress_info(
+                info["progress"],
+                info.get("started") if info["status"] == "running" else None)
     return jsonify(**data), int(job)
 
 
+@backend.route('/api/jobs/<string:id>', methods=['DELETE', ])
+@auth.required()
+def delete_job(id):
+    """Endpoint to cancel a queued or running job."""
+    job = storage.get("job:{0}".format(id))
+    if not job:
+        abort(404)
+    elif int(job) != 200:
+        return jsonify(errors={"msg": "This job has already finished."}), 409
+    cancel_job(id)
+    return Response(status=202)
+
+
 notifs_view = NotificationsAPI.as_view('notifs_api')
 backend.add_url_rule('/api/notifications', defaults={'id': None},
                      view_func=notifs_view, methods=['GET', 'DELETE'])
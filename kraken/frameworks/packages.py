@@ -15,7 +15,7 @@ from flask.views import MethodView
 from arkos.messages import Notification, NotificationThread
 
 from kraken import auth
-from kraken.jobs import as_job, job_response
+from kraken.jobs import as_job, job_response, JobCancelled
 from kraken.records import push_record
 
 backend = Blueprint("packages", __name__)
@@ -48,9 +48,13 @@ class PackagesAPI(MethodView):
         return job_response(id)
 
     def _operation(self, job, install, remove):
+        steps = (2 if install else 0) + (1 if remove else 0)
         if install:
             try:
-                pacman.refresh()
+                job.progress(step=0, steps=steps,
+                             phase="Refreshing package database")
+                _pacman(job, "-Sy")
+                job.progress(step=1, phase="Installing packages")
                 prereqs = pacman.needs_for(install)
                 upgr = (x["id"] for x in pacman.get_installed()
                         if x.get("upgradable"))
@@ -59,14 +63,14 @@ class PackagesAPI(MethodView):
                     msg = "Performing system upgrade..."
                     msg = Notification("info", "Packages", msg)
                     nthread = NotificationThread(id=job.id, message=msg)
-                    pacman.upgrade()
+                    _pacman(job, "-Su")
                 else:
                     # Install
                     title = "Installing {0} package(s)".format(len(prereqs))
                     msg = Notification("info", "Packages", ", ".join(prereqs))
                     nthread = NotificationThread(
                         id=job.id, title=title, message=msg)
-                    pacman.install(install)
+                    _pacman(job, "-S", "--needed", *install)
                 for x in prereqs:
                     try:
                         info = process_info(pacman.get_info(x))
@@ -75,17 +79,21 @@ class PackagesAPI(MethodView):
                         push_record("package", info)
                     except:
                         pass
+            except JobCancelled:
+                raise
             except Exception as e:
                 nthread.complete(Notification("error", "Packages", str(e)))
                 return
         if remove:
             try:
+                job.progress(step=steps - 1, steps=steps,
+                             phase="Removing packages")
                 prereqs = pacman.depends_for(remove)
                 title = "Removing {0} package(s)".format(len(prereqs))
                 msg = Notification("info", "Packages", ", ".join(prereqs))
                 nthread = NotificationThread(
                     id=job.id, title=title, message=msg)
-                pacman.remove(remove)
+                _pacman(job, "-Rc", *remove)
                 for x in prereqs:
                     try:
                         info = process_info(pacman.get_info(x))
@@ -94,13 +102,25 @@ class PackagesAPI(MethodView):
                         push_record("package", info)
                     except:
                         pass
+            except JobCancelled:
+                raise
             except Exception as e:
                 nthread.complete(Notification("error", "Packages", str(e)))
                 return
+        job.progress(step=steps, phase="Done")
         msg = "Operations completed successfully"
         nthread.complete(Notification("success", "Packages", msg))
 
 
+def _pacman(job, *args):
+    # Run transactions as the job's own subprocess, so they can be killed
+    # when the job is cancelled or times out
+    code, stdout, stderr = job.call(["pacman", "--noconfirm"] + list(args))
+    if code != 0:
+        raise Exception("pacman {0} failed: {1}".format(
+            args[0], stderr.decode().strip()))
+
+
 def process_info(info):
     data = {}
     for x in info:
@@ -42,7 +42,8 @@ class UpdatesAPI(MethodView):
 
     @auth.required()
     def post(self):
-        id = as_job(self._post)
+        # Installing again after a restart picks up the remaining updates
+        id = as_job(self._post, resumable=True)
         return job_response(id)
 
     def _post(self, job):
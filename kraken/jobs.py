@@ -7,18 +7,182 @@ Written by Jacob Cook
 Licensed under GPLv3, see LICENSE.md
 """
 
+import bisect
+import eventlet
+import functools
+import hashlib
+import importlib
+import inspect
+import itertools
+import json
+import logging
+import os
+import socket
+import subprocess
 import threading
+import time
 
-from flask import jsonify, Response
+from flask import jsonify, has_request_context, request, Response
 
 from arkos.utilities import random_string
+from arkos.utilities.errors import ConnectionError
 
-from kraken.redis_storage import storage
+from kraken.redis_storage import storage, PoolExhaustedError
 
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
 
-class Job(threading.Thread):
+JOB_EXPIRY = 43200
+"""Time in seconds a finished job's status and descriptor are kept."""
+
+INSTANCE = random_string(16)
+"""Identifies jobs started since this Kraken daemon was launched."""
+
+PROGRESS_INTERVAL = 0.5
+"""Minimum time in seconds between stored progress updates of a job."""
+
+CANCELLED_CODE = 410
+"""Status of a job that was cancelled."""
+
+TIMEOUT_CODE = 504
+"""Status of a job that ran out of time."""
+
+TERMINATE_GRACE = 30
+"""Time in seconds a cancelled job's subprocess has to exit before a kill."""
+
+SLOT_TTL = 30
+"""Time in seconds until a category slot held by a dead worker lapses."""
+
+SLOT_RETRY = 1
+"""Time in seconds between attempts to take a slot held by another worker."""
+
+
+def worker_id(pid=None):
+    """
+    Return a unique name for a worker process.
+
+    :param int pid: Process ID; defaults to the current process
+    :returns: str
+    """
+    return "{0}:{1}".format(socket.gethostname(), pid or os.getpid())
+
+
+class JobCancelled(Exception):
+    """Raised within a job that was cancelled or ran out of time."""
+
+    def __init__(self, id, reason="cancelled"):
+        """
+        Initialize.
+
+        :param str id: Job ID
+        :param str reason: ``cancelled`` or ``timeout``
+        """
+        self.id = id
+        self.reason = reason
+        super().__init__("Job {0} was {1}".format(
+            id, "cancelled" if reason == "cancelled" else "timed out"))
+
+
+def _terminate(process):
+    # Let the process clean up (e.g. pacman releasing its database lock)
+    # before resorting to SIGKILL
+    process.terminate()
+    try:
+        process.wait(TERMINATE_GRACE)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def func_ref(func):
+    """
+    Return a reference to a function that ``resolve()`` can import again.
+
+    :param function func: Function or method
+    :returns: str in the form ``module:qualified.name``
+    """
+    return "{0}:{1}".format(func.__module__, func.__qualname__)
+
+
+def _key_part(value):
+    if value is None or type(value) in [str, int, float, bool]:
+        return value
+    elif type(value) in [list, tuple]:
+        return [_key_part(x) for x in value]
+    elif type(value) == dict:
+        return {str(x): _key_part(y) for x, y in value.items()}
+    elif getattr(value, "id", None) is not None:
+        # arkOS objects (apps, sites, ...) are identified by their ID
+        return "{0}:{1}".format(type(value).__name__, value.id)
+    raise TypeError("Cannot derive a key from {0}".format(type(value)))
+
+
+def idempotency_key(func, args=(), kwargs={}, key=None):
+    """
+    Return the key identifying identical requests for a job.
+
+    :param function func: Function to execute
+    :param tuple args: Arguments to pass to executable function
+    :param dict kwargs: Keyword arguments to pass to executable function
+    :param str key: Key sent by the client, used instead of the arguments
+    :returns: str, or None if the arguments cannot identify the request
+    """
+    if key is None:
+        try:
+            key = json.dumps([_key_part(args), _key_part(kwargs)],
+                             sort_keys=True)
+        except TypeError:
+            return None
+    data = "{0}\n{1}".format(func_ref(func), key)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def progress_info(progress, started=None):
+    """
+    Expand a job's stored progress, with percent done and time remaining.
+
+    :param list progress: Step, steps, bytes done, bytes total and phase
+    :param float started: UNIX timestamp the job started running at
+    :returns: dict
+    """
+    step, steps, done, total, phase = progress
+    data = {"step": step, "steps": steps, "done": done, "total": total,
+            "phase": phase, "percent": None, "eta": None}
+    if total:
+        fraction = float(done or 0) / total
+    elif steps:
+        fraction = float(step or 0) / steps
+    else:
+        return data
+    data["percent"] = round(min(fraction, 1.0) * 100, 1)
+    if started and 0 < fraction < 1:
+        elapsed = time.time() - started
+        data["eta"] = round(elapsed * (1 - fraction) / fraction)
+    return data
+
+
+def resolve(ref):
     """
-    A Job is a long-running process isolated to run in its own thread.
+    Import the function named by ``func_ref()``.
+
+    Methods are bound to a new instance of their class, which must take
+    no arguments (like Flask ``MethodView`` classes).
+
+    :param str ref: Function reference
+    :returns: function
+    """
+    module, path = ref.split(":", 1)
+    obj = importlib.import_module(module)
+    for x in path.split("."):
+        if inspect.isclass(obj):
+            obj = obj()
+        obj = getattr(obj, x)
+    return obj
+
+
+class Job:
+    """
+    A Job is a long-running process isolated to run in a worker thread.
 
     Jobs exist to free up the web server to continue handling requests, and to
     improve performance for the user during long-running operations. It is
@@ -32,52 +196,698 @@ class Job(threading.Thread):
 
         If the job should return a code other than 201 when it finishes
         successfully, send it as the ``success_code`` keyword argument.
+        Jobs are scheduled by ``priority`` (``PRIORITY_HIGH``, ``_NORMAL`` or
+        ``_LOW``), and limited in concurrency by ``category``, which
+        defaults to the name of the function's module (e.g. ``packages``).
+        Jobs that are safe to run again from the start after a restart
+        interrupted them can be marked ``resumable``. Set ``idempotency_key``
+        to a string to override, or False to disable, the deduplication done
+        by ``as_job()``.
 
         :param str id: Job ID
         :param function func: Function to execute
         :param args: Additional arguments to pass to executable function
         :param kwargs: Keyword arguments to pass to executable function
         """
-        threading.Thread.__init__(self)
         self.id = id
         self._func = func
         self._args = args
         self._kwargs = kwargs
         self.status_code = 200
-        if "success_code" in kwargs:
-            self._success_code = kwargs["success_code"]
-            del kwargs["success_code"]
-        else:
-            self._success_code = 201
+        self._success_code = kwargs.pop("success_code", 201)
+        self.priority = kwargs.pop("priority", PRIORITY_NORMAL)
+        self.category = kwargs.pop("category", None) \
+            or func.__module__.rsplit(".", 1)[-1]
+        self.resumable = kwargs.pop("resumable", False)
+        self.key = kwargs.pop("idempotency_key", None)
+        self.created = time.time()
+        self.started = None
+        self._progress = [None, None, None, None, None]
+        self._progress_sent = 0
+        self.cancelled = threading.Event()
+        self.reason = None
+        self._processes = []
+        self._finished = False
+        self._lock = threading.Lock()
+
+    def cancel(self, reason="cancelled"):
+        """
+        Ask the job to stop, and terminate any subprocess attached to it.
+
+        Cancellation is cooperative: the job stops the next time it calls
+        ``check()`` or ``progress()``, or when an attached subprocess dies.
+
+        :param str reason: ``cancelled`` or ``timeout``
+        """
+        with self._lock:
+            if self.cancelled.is_set():
+                return
+            self.reason = reason
+            self.cancelled.set()
+            processes = list(self._processes)
+        for x in processes:
+            if x.poll() is None:
+                self._stop_process(x)
+
+    def check(self):
+        """Raise ``JobCancelled`` if the job was asked to stop."""
+        if self.cancelled.is_set():
+            raise JobCancelled(self.id, self.reason)
+
+    def attach(self, process):
+        """
+        Terminate a subprocess if the job is cancelled while it runs.
+
+        :param subprocess.Popen process: Subprocess started by the job
+        :returns: The subprocess
+        """
+        with self._lock:
+            self._processes.append(process)
+            cancelled = self.cancelled.is_set()
+        if cancelled:
+            self._stop_process(process)
+        return process
+
+    def detach(self, process):
+        """
+        Stop tracking a subprocess attached with ``attach()``.
+
+        :param subprocess.Popen process: Subprocess started by the job
+        """
+        with self._lock:
+            if process in self._processes:
+                self._processes.remove(process)
 
-    def run(self):
-        """Execute the job's function."""
+    def call(self, args):
+        """
+        Run a command in a subprocess attached to the job, and wait for it.
+
+        :param list args: Command and arguments
+        :returns: tuple of return code, standard output and error output
+        """
+        process = self.attach(subprocess.Popen(
+            args, stdout=subprocess.PIPE, stderr=subprocess.PIPE))
+        try:
+            stdout, stderr = process.communicate()
+        finally:
+            self.detach(process)
+        self.check()
+        return process.returncode, stdout, stderr
+
+    def progress(self, step=None, steps=None, done=None, total=None,
+                 phase=None):
+        """
+        Report how far along the job is.
+
+        Only the values given are updated. Updates are stored and pushed
+        to clients at most every ``PROGRESS_INTERVAL`` seconds, unless the
+        phase changes.
+
+        :param int step: Number of the current step
+        :param int steps: Total number of steps
+        :param int done: Bytes (or other units) processed so far
+        :param int total: Total bytes (or other units) to process
+        :param str phase: Description of the current phase
+        """
+        self.check()
+        changed = phase is not None and phase != self._progress[4]
+        for i, x in enumerate([step, steps, done, total, phase]):
+            if x is not None:
+                self._progress[i] = x
+        now = time.time()
+        if not changed and now - self._progress_sent < PROGRESS_INTERVAL:
+            return
+        self._progress_sent = now
+        pipe = storage.pipeline()
+        storage.set("jobs:{0}".format(self.id),
+                    {"progress": self._progress}, pipe=pipe)
+        storage.publish("jobs:progress", dict(
+            progress_info(self._progress, self.started), id=self.id),
+            pipe=pipe)
+        storage.execute(pipe)
+
+    def descriptor(self):
+        """
+        Return the job's descriptor, as persisted in storage.
+
+        Arguments that cannot be serialized are left out, and the job is
+        then not resumable.
+
+        :returns: dict
+        """
+        data = {"func": func_ref(self._func), "status": "queued",
+                "category": self.category, "priority": self.priority,
+                "success_code": self._success_code, "created": self.created,
+                "instance": INSTANCE, "worker": worker_id(),
+                "key": self.key, "args": None,
+                "kwargs": None, "resumable": False}
+        try:
+            storage.codec.dumps([list(self._args), self._kwargs])
+        except (TypeError, ValueError, OverflowError):
+            return data
+        data.update(args=list(self._args), kwargs=self._kwargs,
+                    resumable=self.resumable)
+        return data
+
+    def save(self):
+        """Persist the job's descriptor, status and index entry."""
+        pipe = storage.pipeline()
+        storage.set("jobs:{0}".format(self.id), self.descriptor(), pipe=pipe)
+        storage.set("job:{0}".format(self.id), self.status_code, pipe=pipe)
+        storage.sortlist_add("jobindex", self.created, self.id, pipe=pipe)
+        storage.execute(pipe)
+
+    def run(self, timeout=None, expired=None):
+        """
+        Execute the job's function.
+
+        A job that runs out of time is recorded as timed out at once, even
+        if its function does not stop.
+
+        :param float timeout: Seconds after which the job is cancelled
+        :param function expired: Called when the job runs out of time
+        """
+        if self.cancelled.is_set():
+            self.stop()
+            return
+        self.started = time.time()
         storage.set("job:{0}".format(self.id), self.status_code)
+        storage.set("jobs:{0}".format(self.id),
+                    {"status": "running", "started": self.started})
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, self._expire, (expired,))
+            timer.daemon = True
+            timer.start()
         try:
-            self._func(self, *self._args, **self._kwargs)
+            result = self._func(self, *self._args, **self._kwargs)
         except Exception as e:
-            self.status_code = 500
-            storage.set("job:{0}".format(self.id), self.status_code)
+            if self.cancelled.is_set():
+                # Errors from killed subprocesses are part of cancelling
+                self.stop()
+                return
+            self._finish(500, {"status": "failed", "error": str(e)})
             raise
         else:
-            storage.set("job:{0}".format(self.id), self._success_code)
-        storage.expire("job:{0}".format(self.id), 43200)
+            try:
+                storage.codec.dumps(result)
+            except (TypeError, ValueError, OverflowError):
+                result = None
+            self._finish(self._success_code,
+                         {"status": "finished", "result": result})
+        finally:
+            if timer:
+                timer.cancel()
+
+    def stop(self):
+        """Record the job as cancelled or timed out."""
+        timeout = self.reason == "timeout"
+        self._finish(TIMEOUT_CODE if timeout else CANCELLED_CODE,
+                     {"status": "timeout" if timeout else "cancelled",
+                      "error": str(JobCancelled(self.id, self.reason))})
+
+    def _stop_process(self, process):
+        # Waiting for the process must not block the caller, which may be
+        # the web server's hub thread
+        threading.Thread(target=_terminate, args=(process,),
+                         daemon=True).start()
+
+    def _expire(self, callback=None):
+        if self._finished:
+            return
+        self.cancel("timeout")
+        # The job's thread can't be killed, so don't wait for it to notice
+        self.stop()
+        if callback:
+            callback()
+
+    def _finish(self, status_code, data):
+        # Only the first outcome counts, e.g. a timeout over a late result
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        self.status_code = status_code
+        data["finished"] = time.time()
+        pipe = storage.pipeline()
+        storage.set("jobs:{0}".format(self.id), data, pipe=pipe)
+        storage.expire("jobs:{0}".format(self.id), JOB_EXPIRY, pipe=pipe)
+        storage.set("job:{0}".format(self.id), self.status_code, pipe=pipe,
+                    expiry=JOB_EXPIRY)
+        if self.key:
+            # Identical requests from now on start a new job
+            storage.delete("jobkey:{0}".format(self.key), pipe=pipe)
+        storage.publish("jobs:done", {"id": self.id, "status": status_code},
+                        pipe=pipe)
+        storage.execute(pipe)
+
+
+class Scheduler:
+    """
+    Run jobs on a fixed pool of worker threads.
+
+    Queued jobs are started in order of priority, then submission. A job
+    whose category is already running at its concurrency limit is passed
+    over until a slot frees up, without holding up other categories.
+
+    Limits apply across all worker processes: a job of a limited category
+    runs while holding one of the category's slots, a lock in storage.
+    Slots are renewed while their job runs, and lapse if the worker dies.
+    """
+
+    def __init__(self):
+        """Initialize."""
+        self.size = 4
+        self.limits = {}
+        self.timeouts = {}
+        self.timeout = None
+        self.queue = []
+        self.running = {}
+        self.jobs = {}
+        self.slots = {}
+        self.stats = {"submitted": 0, "completed": 0, "max_queued": 0,
+                      "cancelled": 0}
+        self._workers = []
+        self._abandoned = set()
+        self._renewer = None
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+
+    def configure(self, size=4, limits={}, timeouts={}, timeout=None):
+        """
+        Set the pool size, and per-category concurrency limits and timeouts.
+
+        :param int size: Number of worker threads
+        :param dict limits: Maximum running jobs, by category
+        :param dict timeouts: Maximum running time in seconds, by category
+        :param float timeout: Maximum running time of other jobs
+        """
+        with self._cond:
+            self.size = size
+            self.limits = dict(limits)
+            self.timeouts = dict(timeouts)
+            self.timeout = timeout
+
+    def submit(self, job):
+        """
+        Queue a job to be run by the next free worker.
+
+        :param Job job: Job to run
+        """
+        with self._cond:
+            bisect.insort(self.queue,
+                          (job.priority, next(self._order), job.id, job))
+            self.jobs[job.id] = job
+            self.stats["submitted"] += 1
+            self.stats["max_queued"] = max(self.stats["max_queued"],
+                                           len(self.queue))
+            # Workers are started lazily, so none are inherited over fork
+            while len(self._workers) < self.size:
+                self._start_worker()
+            if self._renewer is None:
+                self._renewer = threading.Thread(target=self._renew,
+                                                 daemon=True)
+                self._renewer.start()
+            self._cond.notify_all()
+
+    def position(self, id):
+        """
+        Return the number of queued jobs ahead of a job.
+
+        :param str id: Job ID
+        :returns: Queue position from 0, or None if the job is not queued
+        """
+        with self._cond:
+            for i, x in enumerate(self.queue):
+                if x[2] == id:
+                    return i
+        return None
+
+    def cancel(self, id, reason="cancelled"):
+        """
+        Cancel a job queued or running in this process.
+
+        :param str id: Job ID
+        :param str reason: ``cancelled`` or ``timeout``
+        :returns: True if the job was found
+        """
+        with self._cond:
+            job = self.jobs.get(id)
+            if not job:
+                return False
+            queued = [x for x in self.queue if x[2] == id]
+            for x in queued:
+                self.queue.remove(x)
+                del self.jobs[id]
+            self.stats["cancelled"] += 1
+        job.cancel(reason)
+        if queued:
+            job.stop()
+        return True
+
+    def get_stats(self):
+        """
+        Return scheduler statistics.
+
+        :returns: dict
+        """
+        with self._cond:
+            return dict(self.stats, queued=len(self.queue),
+                        running=dict(self.running))
+
+    def _candidates(self):
+        # Called with the condition held: the queued jobs that may start, in
+        # order, up to the first one that needs no category slot
+        jobs, seen = [], set()
+        for x in self.queue:
+            job = x[3]
+            limit = self.limits.get(job.category)
+            if limit is None:
+                jobs.append(job)
+                break
+            if job.category not in seen \
+                    and self.running.get(job.category, 0) < limit:
+                jobs.append(job)
+            seen.add(job.category)
+        return jobs
+
+    def _next(self):
+        with self._cond:
+            candidates = self._candidates()
+            while not candidates:
+                self._cond.wait()
+                candidates = self._candidates()
+        # Slots are taken without holding the condition, which the web
+        # server's thread waits for, as storage may be slow to respond
+        for job in candidates:
+            limit = self.limits.get(job.category)
+            if limit is not None and not self._take_slot(job, limit):
+                continue
+            with self._cond:
+                queued = [x for x in self.queue if x[3] is job]
+                if queued and (limit is None or
+                               self.running.get(job.category, 0) < limit):
+                    self.queue.remove(queued[0])
+                    self.running[job.category] = \
+                        self.running.get(job.category, 0) + 1
+                    return job
+            # Cancelled or overtaken by another thread in the meantime
+            self._release_slot(job.id)
+        return None
+
+    def _take_slot(self, job, limit):
+        owner = "{0}/{1}".format(worker_id(), job.id)
+        for x in range(limit):
+            name = "jobslot:{0}:{1}".format(job.category, x)
+            try:
+                if storage.acquire_lock(name, owner, SLOT_TTL):
+                    with self._cond:
+                        self.slots[job.id] = (name, owner)
+                    return True
+            except (ConnectionError, PoolExhaustedError):
+                return False
+        return False
+
+    def _release_slot(self, id):
+        with self._cond:
+            slot = self.slots.pop(id, None)
+        if slot:
+            try:
+                storage.release_lock(*slot)
+            except (ConnectionError, PoolExhaustedError):
+                # The slot lapses on its own
+                pass
+
+    def _renew(self):
+        while True:
+            time.sleep(SLOT_TTL / 3.0)
+            with self._cond:
+                slots = list(self.slots.values())
+            for name, owner in slots:
+                try:
+                    storage.renew_lock(name, owner, SLOT_TTL)
+                except (ConnectionError, PoolExhaustedError):
+                    pass
+
+    def _start_worker(self):
+        worker = threading.Thread(target=self._work, daemon=True)
+        self._workers.append(worker)
+        worker.start()
+
+    def _free(self, job):
+        # Called with the condition held; False if the job was freed before
+        if self.jobs.pop(job.id, None) is None:
+            return False
+        self.running[job.category] -= 1
+        self._cond.notify_all()
+        return True
+
+    def _abandon(self, job):
+        # A job that ran out of time gives up its slot at once; its worker
+        # is replaced until the job's function returns
+        with self._cond:
+            if not self._free(job):
+                # The job returned in the meantime
+                return
+            self._abandoned.add(job.id)
+            self._start_worker()
+        self._release_slot(job.id)
+
+    def _work(self):
+        while True:
+            job = self._next()
+            if not job:
+                # Slots taken by other workers free up without notice
+                with self._cond:
+                    self._cond.wait(SLOT_RETRY)
+                continue
+            with self._cond:
+                timeout = self.timeouts.get(job.category, self.timeout)
+            try:
+                job.run(timeout, functools.partial(self._abandon, job))
+            except Exception:
+                # Already recorded as a failed job status
+                logging.getLogger(__name__).exception(
+                    "Job %s failed", job.id)
+            finally:
+                self._release_slot(job.id)
+                with self._cond:
+                    self._free(job)
+                    self.stats["completed"] += 1
+                    if job.id in self._abandoned:
+                        self._abandoned.discard(job.id)
+                        self._workers.remove(threading.current_thread())
+                        return
+
+
+scheduler = Scheduler()
+
+_waiters = {}
 
 
 def as_job(func, *args, **kwargs):
     """
-    Create and execute a Job.
+    Create and queue a Job.
+
+    If an identical job is still queued or running, its ID is returned
+    instead. Jobs are identical if their function and arguments match, or
+    if they were requested with the same ``Idempotency-Key`` header.
 
     :param function func: Function to execute
     :param args: Additional arguments to pass to executable function
     :param kwargs: Keyword arguments to pass to executable function
+    :returns: Job ID
     """
     id = random_string(16)
     j = Job(id, func, *args, **kwargs)
-    j.start()
+    key = j.key
+    if key is None and has_request_context():
+        key = request.headers.get("Idempotency-Key")
+    j.key = idempotency_key(func, args, j._kwargs, key) \
+        if key is not False else None
+    if j.key:
+        existing = storage.claim("jobkey:{0}".format(j.key), id, JOB_EXPIRY)
+        if existing:
+            return existing
+    try:
+        j.save()
+        scheduler.submit(j)
+    except Exception:
+        # Otherwise identical requests would wait on a job that never runs
+        if j.key:
+            storage.delete("jobkey:{0}".format(j.key))
+        raise
     return id
 
 
+def cancel_job(id):
+    """
+    Cancel a job, wherever it is queued or running.
+
+    Jobs not found in this process are cancelled by whichever worker
+    process has them, through the ``jobs:cancel`` channel.
+
+    :param str id: Job ID
+    """
+    if not scheduler.cancel(id):
+        storage.publish("jobs:cancel", id)
+
+
+def list_jobs(status=None, category=None, since=None, cursor=None,
+              limit=50):
+    """
+    Return jobs from the job index, newest first.
+
+    Index entries whose descriptor has expired are removed on the way.
+
+    :param str status: Only return jobs with this status
+    :param str category: Only return jobs of this category
+    :param float since: Only return jobs created at or after this time
+    :param float cursor: Only return jobs created before this time, as
+        returned for the previous page
+    :param int limit: Max number of jobs to return
+    :returns: tuple of job summaries and the cursor of the next page
+    """
+    jobs, expired = [], []
+    low = since if since is not None else "-inf"
+    high = "({0!r}".format(cursor) if cursor is not None else "+inf"
+    while True:
+        page = storage.sortlist_range("jobindex", low, high, start=0,
+                                      num=limit, reverse=True)
+        infos = storage.get_all_many(["jobs:{0}".format(x) for x, y in page])
+        for (id, created), info in zip(page, infos):
+            high = "({0!r}".format(created)
+            if not info:
+                expired.append(id)
+            elif (not status or info.get("status") == status) \
+                    and (not category or info.get("category") == category):
+                jobs.append({"id": id, "status": info.get("status"),
+                             "category": info.get("category"),
+                             "created": info.get("created"),
+                             "finished": info.get("finished")})
+                if len(jobs) == limit:
+                    storage.sortlist_remove("jobindex", expired)
+                    return jobs, created
+        if len(page) < limit:
+            storage.sortlist_remove("jobindex", expired)
+            return jobs, None
+
+
+def job_done(data):
+    """
+    Wake up requests waiting for a job that finished, in any process.
+
+    Handles messages on the ``jobs:done`` channel.
+
+    :param dict data: Job ID and status code
+    """
+    for x in _waiters.pop(data["id"], []):
+        x.send(data["status"])
+
+
+def wait_for_job(id, timeout):
+    """
+    Wait for a job to finish, without blocking other green threads.
+
+    Waiters are woken up by ``job_done()`` when the job, running in this
+    or another worker process, publishes its outcome.
+
+    :param str id: Job ID
+    :param float timeout: Max time in seconds to wait
+    :returns: Job status code, or None if the job is unknown
+    """
+    event = eventlet.Event()
+    _waiters.setdefault(id, []).append(event)
+    try:
+        # Read past the cache, as the job may have just finished
+        pipe = storage.pipeline()
+        storage.get("job:{0}".format(id), pipe=pipe)
+        status = storage.execute(pipe)[0]
+        status = int(status) if status else None
+        if status != 200:
+            return status
+        with eventlet.Timeout(timeout, False):
+            return event.wait()
+        return status
+    finally:
+        waiters = _waiters.get(id, [])
+        if event in waiters:
+            waiters.remove(event)
+        if not waiters:
+            _waiters.pop(id, None)
+
+
+def get_job_info(id):
+    """
+    Return the persisted descriptor of a job.
+
+    :param str id: Job ID
+    :returns: dict, or None if the job is unknown or has expired
+    """
+    return storage.get_all("jobs:{0}".format(id)) or None
+
+
+def recover_jobs(resume=True, worker=None):
+    """
+    Deal with jobs left queued or running by a previous Kraken daemon.
+
+    Resumable jobs are queued again under their original ID, if ``resume``
+    is set. All others are marked as orphaned and failed.
+
+    :param bool resume: Resume jobs marked as resumable
+    :param str worker: Only deal with the jobs of this worker process of
+        the current daemon, which died
+    :returns: tuple of the numbers of jobs resumed and orphaned
+    """
+    resumed, orphaned = 0, 0
+    if not worker:
+        # Drop index entries of jobs that have expired
+        expired = []
+        for id, created in storage.sortlist_range("jobindex"):
+            if created < time.time() - JOB_EXPIRY \
+                    and not storage.exists("jobs:{0}".format(id)):
+                expired.append(id)
+        storage.sortlist_remove("jobindex", expired)
+    for x in storage.scan_iter("jobs:*"):
+        id = x.split("arkos:jobs:", 1)[1]
+        info = get_job_info(id)
+        if not info or info.get("status") not in ["queued", "running"]:
+            continue
+        if worker and info.get("worker") != worker:
+            continue
+        elif not worker and info.get("instance") == INSTANCE:
+            continue
+        if resume and info.get("resumable"):
+            try:
+                func = resolve(info["func"])
+            except (ImportError, AttributeError, TypeError, ValueError):
+                func = None
+            if func:
+                kwargs = dict(info.get("kwargs") or {},
+                              success_code=info["success_code"],
+                              priority=info["priority"],
+                              category=info["category"], resumable=True,
+                              idempotency_key=info.get("key"))
+                j = Job(id, func, *(info.get("args") or []), **kwargs)
+                storage.delete("jobs:{0}".format(id))
+                j.save()
+                scheduler.submit(j)
+                resumed += 1
+                continue
+        pipe = storage.pipeline()
+        storage.set("jobs:{0}".format(id),
+                    {"status": "orphaned", "finished": time.time(),
+                     "error": "Interrupted by a restart"}, pipe=pipe)
+        storage.expire("jobs:{0}".format(id), JOB_EXPIRY, pipe=pipe)
+        storage.set("job:{0}".format(id), 500, pipe=pipe, expiry=JOB_EXPIRY)
+        if info.get("key"):
+            storage.delete("jobkey:{0}".format(info["key"]), pipe=pipe)
+        storage.publish("jobs:done", {"id": id, "status": 500}, pipe=pipe)
+        storage.execute(pipe)
+        orphaned += 1
+    return resumed, orphaned
+
+
 def job_response(id, data=None):
     """
     Respond to a request with job tracking information.
@@ -27,11 +27,8 @@ class APIHandler(logging.Handler):
         logtime = logtime.isoformat()
         data.update({"cls": data["cls"], "level": record.levelname.lower(),
                      "time": logtime})
-        pipe = storage.pipeline()
-        storage.publish("notifications", data, pipe)
-        storage.prepend("n:{0}".format(data["id"]), data, pipe)
-        storage.expire("n:{0}".format(data["id"]), 604800, pipe)
-        pipe.execute()
+        storage.publish_prepend(
+            "notifications", "n:{0}".format(data["id"]), data, 604800)
 
 
 class FileFormatter(logging.Formatter):
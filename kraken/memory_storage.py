@@ -0,0 +1,482 @@
+"""
+Classes to keep Kraken's ephemeral data in process memory.
+
+The engine implements the subset of the redis-py client interface that
+``kraken.redis_storage.Storage`` relies upon, so it can stand in for a Redis
+server on single-node installs. Keys and values are handled as bytes, like
+responses from Redis.
+
+arkOS Kraken
+(c) 2016 CitizenWeb
+Written by Jacob Cook
+Licensed under GPLv3, see LICENSE.md
+"""
+
+import collections
+import fnmatch
+import hashlib
+import os
+import threading
+import time
+
+from redis.exceptions import NoScriptError, ResponseError
+
+WRONGTYPE = "WRONGTYPE Operation against a key holding the wrong kind of value"
+
+
+def _b(value):
+    if type(value) == bytes:
+        return value
+    elif type(value) == str:
+        return value.encode("utf-8")
+    return str(value).encode("utf-8")
+
+
+class SortedSet(dict):
+    """Members of a sorted set, mapped to their scores."""
+
+
+def _in_range(score, min, max):
+    for bound, lower in [(min, True), (max, False)]:
+        bound = bound.decode() if type(bound) == bytes else str(bound)
+        exclusive = bound.startswith("(")
+        limit = float(bound.lstrip("("))
+        if (score < limit if lower else score > limit) \
+                or (exclusive and score == limit):
+            return False
+    return True
+
+
+class MemoryConnectionPool:
+    """Stand-in for a connection pool; there are no connections to manage."""
+
+    def disconnect(self):
+        pass
+
+    def get_stats(self):
+        return {}
+
+
+class MemoryRedis:
+    """An in-process engine that behaves like a Redis client."""
+
+    def __init__(self, scripts={}):
+        """
+        Initialize.
+
+        :param dict scripts: Lua sources by name, whose behaviour is
+            provided natively by ``SCRIPT_HANDLERS``
+        """
+        self.connection_pool = MemoryConnectionPool()
+        self._data = {}
+        self._expires = {}
+        self._subscribers = []
+        self._scripts = {}
+        self._names = {source: name for name, source in scripts.items()}
+        self._lock = threading.RLock()
+
+    def _alive(self, name):
+        deadline = self._expires.get(name)
+        if deadline is not None and deadline <= time.time():
+            del self._expires[name]
+            self._data.pop(name, None)
+        return name in self._data
+
+    def _fetch(self, name, kind):
+        name = _b(name)
+        if not self._alive(name):
+            return None
+        value = self._data[name]
+        if type(value) != kind:
+            raise ResponseError(WRONGTYPE)
+        return value
+
+    def _create(self, name, kind):
+        value = self._fetch(name, kind)
+        if value is None:
+            value = kind()
+            self._data[_b(name)] = value
+        return value
+
+    def _drop_empty(self, name):
+        name = _b(name)
+        if not self._data.get(name):
+            self._data.pop(name, None)
+            self._expires.pop(name, None)
+
+    def execute_command(self, *args, **options):
+        """Execute a command given in Redis argument order."""
+        return getattr(self, args[0].lower())(*args[1:], **options)
+
+    def ping(self):
+        return True
+
+    def flushdb(self):
+        with self._lock:
+            self._data.clear()
+            self._expires.clear()
+        return True
+
+    def config_set(self, name, value):
+        return True
+
+    def get(self, name):
+        with self._lock:
+            return self._fetch(name, bytes)
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        with self._lock:
+            name = _b(name)
+            exists = self._alive(name)
+            if (nx and exists) or (xx and not exists):
+                return None
+            self._data[name] = _b(value)
+            self._expires.pop(name, None)
+            if ex or px:
+                self._expires[name] = time.time() + (ex or px / 1000.0)
+            return True
+
+    def hget(self, name, key):
+        with self._lock:
+            return (self._fetch(name, dict) or {}).get(_b(key))
+
+    def hgetall(self, name):
+        with self._lock:
+            return dict(self._fetch(name, dict) or {})
+
+    def hset(self, name, key, value):
+        with self._lock:
+            data = self._create(name, dict)
+            new = _b(key) not in data
+            data[_b(key)] = _b(value)
+            return int(new)
+
+    def hmset(self, name, mapping):
+        with self._lock:
+            data = self._create(name, dict)
+            data.update({_b(x): _b(y) for x, y in mapping.items()})
+            return True
+
+    def hdel(self, name, *keys):
+        with self._lock:
+            data = self._fetch(name, dict) or {}
+            removed = len([data.pop(_b(x)) for x in keys if _b(x) in data])
+            self._drop_empty(name)
+            return removed
+
+    def lpush(self, name, *values):
+        with self._lock:
+            data = self._create(name, list)
+            for x in values:
+                data.insert(0, _b(x))
+            return len(data)
+
+    def rpush(self, name, *values):
+        with self._lock:
+            data = self._create(name, list)
+            data.extend(_b(x) for x in values)
+            return len(data)
+
+    def lpop(self, name):
+        with self._lock:
+            data = self._fetch(name, list)
+            if not data:
+                return None
+            value = data.pop(0)
+            self._drop_empty(name)
+            return value
+
+    def lindex(self, name, index):
+        with self._lock:
+            data = self._fetch(name, list) or []
+            index = int(index)
+            if -len(data) <= index < len(data):
+                return data[index]
+            return None
+
+    def lrange(self, name, start, end):
+        with self._lock:
+            data = self._fetch(name, list) or []
+            end = int(end)
+            return data[int(start):(None if end == -1 else end + 1)]
+
+    def lrem(self, name, count, value):
+        with self._lock:
+            data = self._fetch(name, list) or []
+            value, count = _b(value), int(count)
+            indices = [i for i, x in enumerate(data) if x == value]
+            if count < 0:
+                indices = indices[::-1][:-count]
+            elif count > 0:
+                indices = indices[:count]
+            for i in sorted(indices, reverse=True):
+                del data[i]
+            self._drop_empty(name)
+            return len(indices)
+
+    def zadd(self, name, *args, **kwargs):
+        with self._lock:
+            data = self._create(name, SortedSet)
+            if args and type(args[0]) == dict:
+                pairs = [(x, y) for x, y in args[0].items()]
+            else:
+                pairs = list(zip(args[::2], args[1::2]))
+            pairs += list(kwargs.items())
+            new = len([x for x, y in pairs if _b(x) not in data])
+            for member, score in pairs:
+                data[_b(member)] = float(score)
+            return new
+
+    def zrangebyscore(self, name, min, max, start=None, num=None,
+                      withscores=False):
+        with self._lock:
+            data = self._fetch(name, SortedSet) or {}
+            items = sorted((y, x) for x, y in data.items()
+                           if _in_range(y, min, max))
+            return self._zslice(items, start, num, withscores)
+
+    def zrevrangebyscore(self, name, max, min, start=None, num=None,
+                         withscores=False):
+        with self._lock:
+            data = self._fetch(name, SortedSet) or {}
+            items = sorted(((y, x) for x, y in data.items()
+                            if _in_range(y, min, max)), reverse=True)
+            return self._zslice(items, start, num, withscores)
+
+    def _zslice(self, items, start, num, withscores):
+        if start is not None and num is not None:
+            items = items[start:start + num]
+        if withscores:
+            return [(x, y) for y, x in items]
+        return [x for y, x in items]
+
+    def zremrangebyscore(self, name, min, max):
+        with self._lock:
+            data = self._fetch(name, SortedSet) or {}
+            members = [x for x, y in data.items() if _in_range(y, min, max)]
+            for x in members:
+                del data[x]
+            self._drop_empty(name)
+            return len(members)
+
+    def zrem(self, name, *values):
+        with self._lock:
+            data = self._fetch(name, SortedSet) or {}
+            removed = len([data.pop(_b(x)) for x in values if _b(x) in data])
+            self._drop_empty(name)
+            return removed
+
+    def zcard(self, name):
+        with self._lock:
+            return len(self._fetch(name, SortedSet) or {})
+
+    def delete(self, *names):
+        with self._lock:
+            removed = 0
+            for x in names:
+                if self._alive(_b(x)):
+                    del self._data[_b(x)]
+                    self._expires.pop(_b(x), None)
+                    removed += 1
+            return removed
+
+    def exists(self, name):
+        with self._lock:
+            return self._alive(_b(name))
+
+    def expire(self, name, time_):
+        with self._lock:
+            if not self._alive(_b(name)):
+                return False
+            self._expires[_b(name)] = time.time() + int(time_)
+            return True
+
+    def ttl(self, name):
+        with self._lock:
+            if not self._alive(_b(name)):
+                return -2
+            deadline = self._expires.get(_b(name))
+            return -1 if deadline is None else int(deadline - time.time())
+
+    def scan(self, cursor=0, match=None, count=None):
+        with self._lock:
+            names = [x for x in list(self._data) if self._alive(x)]
+        if match:
+            names = [x for x in names
+                     if fnmatch.fnmatchcase(x.decode(), _b(match).decode())]
+        return 0, names
+
+    def publish(self, channel, message):
+        channel, message = _b(channel), _b(message)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        return len([x for x in subscribers if x._deliver(channel, message)])
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return MemoryPubSub(self)
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+    def script_load(self, source):
+        sha = hashlib.sha1(_b(source)).hexdigest()
+        if source not in self._names:
+            raise ResponseError("Script is not supported by the memory "
+                                "storage engine")
+        self._scripts[sha] = self._names[source]
+        return sha
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        if sha not in self._scripts:
+            raise NoScriptError("No matching script")
+        handler = SCRIPT_HANDLERS[self._scripts[sha]]
+        with self._lock:
+            return handler(self, keys_and_args[:numkeys],
+                           keys_and_args[numkeys:])
+
+    def eval(self, source, numkeys, *keys_and_args):
+        return self.evalsha(self.script_load(source), numkeys,
+                            *keys_and_args)
+
+
+class MemoryPipeline:
+    """Queue commands on the memory engine and run them in one step."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.command_stack = []
+
+    def __getattr__(self, name):
+        def queue(*args, **options):
+            self.command_stack.append(((name.upper(),) + args, options))
+            return self
+        return queue
+
+    def execute_command(self, *args, **options):
+        self.command_stack.append((args, options))
+        return self
+
+    def execute(self):
+        commands, self.command_stack = self.command_stack, []
+        with self.engine._lock:
+            return [self.engine.execute_command(*args, **options)
+                    for args, options in commands]
+
+
+class MemoryPubSub:
+    """
+    Receive messages published on the memory engine.
+
+    Each delivery also writes a byte to an internal pipe, so that a
+    listener can wait on ``fileno()`` like on a Redis connection socket.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.channels = set()
+        self.patterns = set()
+        self._messages = collections.deque()
+        self._rfd, self._wfd = os.pipe()
+        os.set_blocking(self._rfd, False)
+        os.set_blocking(self._wfd, False)
+        with engine._lock:
+            engine._subscribers.append(self)
+
+    def subscribe(self, *channels):
+        for x in channels:
+            if type(x) in [list, tuple]:
+                self.channels.update(_b(y) for y in x)
+            else:
+                self.channels.add(_b(x))
+
+    def unsubscribe(self, *channels):
+        self.channels.difference_update(_b(x) for x in channels)
+
+    def psubscribe(self, *patterns):
+        self.patterns.update(_b(x) for x in patterns)
+
+    def _deliver(self, channel, message):
+        if channel in self.channels:
+            msg = {"type": "message", "pattern": None,
+                   "channel": channel, "data": message}
+        else:
+            patterns = [x for x in self.patterns
+                        if fnmatch.fnmatchcase(channel.decode(), x.decode())]
+            if not patterns:
+                return False
+            msg = {"type": "pmessage", "pattern": patterns[0],
+                   "channel": channel, "data": message}
+        self._messages.append(msg)
+        try:
+            os.write(self._wfd, b"\0")
+        except BlockingIOError:
+            # The pipe is full, so the listener is already due to wake up
+            pass
+        return True
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0):
+        try:
+            return self._messages.popleft()
+        except IndexError:
+            try:
+                while os.read(self._rfd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+            return None
+
+    def can_read(self):
+        """Return True if messages are waiting to be read."""
+        return bool(self._messages)
+
+    def fileno(self):
+        """Return a file descriptor that is readable when messages arrive."""
+        return self._rfd
+
+    def close(self):
+        with self.engine._lock:
+            if self in self.engine._subscribers:
+                self.engine._subscribers.remove(self)
+        os.close(self._rfd)
+        os.close(self._wfd)
+
+
+def _remove_all(engine, keys, args):
+    data = engine._fetch(keys[0], list) or []
+    drop = set(_b(x) for x in args)
+    keep = [x for x in data if x not in drop]
+    removed = len(data) - len(keep)
+    data[:] = keep
+    engine._drop_empty(keys[0])
+    return removed
+
+
+def _replace_list(engine, keys, args):
+    engine.delete(keys[0])
+    engine.rpush(keys[0], *args)
+    return len(args)
+
+
+def _publish_prepend(engine, keys, args):
+    engine.publish(args[0], args[1])
+    engine.lpush(keys[0], args[2])
+    if int(args[3]) > 0:
+        engine.expire(keys[0], args[3])
+    return 1
+
+
+def _refresh_lock(engine, keys, args):
+    if engine.get(keys[0]) != _b(args[0]):
+        return 0
+    elif int(args[1]) > 0:
+        return int(engine.expire(keys[0], args[1]))
+    return engine.delete(keys[0])
+
+
+SCRIPT_HANDLERS = {
+    "remove_all": _remove_all,
+    "replace_list": _replace_list,
+    "publish_prepend": _publish_prepend,
+    "refresh_lock": _refresh_lock
+}
+"""Native implementations of the Lua scripts registered by Storage."""
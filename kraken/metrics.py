@@ -0,0 +1,209 @@
+"""
+Classes to record latency and throughput of storage commands.
+
+arkOS Kraken
+(c) 2016 CitizenWeb
+Written by Jacob Cook
+Licensed under GPLv3, see LICENSE.md
+"""
+
+import bisect
+import threading
+import time
+
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000)
+"""Upper bounds (in milliseconds) of the command latency histogram."""
+
+PIPELINE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250)
+"""Upper bounds of the pipeline size histogram."""
+
+
+def key_prefix(key):
+    """
+    Return the tag used to group metrics for a key or channel name.
+
+    ``arkos:n:1234`` is tagged ``n:``, ``arkos:records:push`` is tagged
+    ``records:`` and ``arkos:notifications`` is tagged ``notifications``.
+
+    :param key: Key or channel name
+    :returns: str
+    """
+    if type(key) == bytes:
+        key = key.decode("utf-8", "replace")
+    if type(key) != str or not key.startswith("arkos:"):
+        return ""
+    parts = key.split(":", 2)
+    return parts[1] + ":" if len(parts) > 2 else parts[1]
+
+
+def _size(value):
+    if type(value) in [bytes, str]:
+        return len(value)
+    elif type(value) in [list, tuple]:
+        return sum(_size(x) for x in value)
+    elif type(value) == dict:
+        return sum(_size(x) + _size(y) for x, y in value.items())
+    return 0
+
+
+class Histogram:
+    """Count observations in fixed buckets."""
+
+    def __init__(self, buckets):
+        """
+        Initialize.
+
+        :param tuple buckets: Upper bounds of each bucket, ascending
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+
+    def observe(self, value):
+        """
+        Count an observation.
+
+        :param float value: Observed value
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+
+    def serialized(self):
+        labels = [str(x) for x in self.buckets] + ["+Inf"]
+        return dict(zip(labels, self.counts))
+
+
+class StorageMetrics:
+    """Per-command and per-pipeline statistics, tagged by key prefix."""
+
+    def __init__(self):
+        """Initialize."""
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Discard all recorded statistics."""
+        with self._lock:
+            self.commands = {}
+            self.pipelines = {"count": 0, "commands": 0, "time": 0.0,
+                              "sizes": Histogram(PIPELINE_BUCKETS)}
+
+    def record(self, command, key, elapsed, sent, received, failed=False):
+        """
+        Record the execution of a single command.
+
+        :param str command: Command name
+        :param key: Key or channel the command operated on
+        :param float elapsed: Execution time in seconds
+        :param int sent: Bytes sent as arguments
+        :param int received: Bytes received in the response
+        :param bool failed: True if the command raised an error
+        """
+        name = (command.upper(), key_prefix(key))
+        with self._lock:
+            data = self.commands.get(name)
+            if not data:
+                data = {"count": 0, "errors": 0, "time": 0.0,
+                        "bytes_out": 0, "bytes_in": 0,
+                        "latency": Histogram(LATENCY_BUCKETS)}
+                self.commands[name] = data
+            data["count"] += 1
+            data["errors"] += int(failed)
+            data["time"] += elapsed
+            data["bytes_out"] += sent
+            data["bytes_in"] += received
+            data["latency"].observe(elapsed * 1000)
+
+    def record_pipeline(self, commands, elapsed):
+        """
+        Record the execution of a pipeline.
+
+        :param int commands: Number of commands in the pipeline
+        :param float elapsed: Execution time in seconds
+        """
+        with self._lock:
+            self.pipelines["count"] += 1
+            self.pipelines["commands"] += commands
+            self.pipelines["time"] += elapsed
+            self.pipelines["sizes"].observe(commands)
+
+    def serialized(self):
+        with self._lock:
+            commands = {}
+            for (command, prefix), data in self.commands.items():
+                data = dict(data, latency=data["latency"].serialized())
+                commands.setdefault(command, {})[prefix or "*"] = data
+            pipelines = dict(self.pipelines,
+                             sizes=self.pipelines["sizes"].serialized())
+        return {"commands": commands, "pipelines": pipelines}
+
+
+class MeteredClient:
+    """Wrap a storage client to time every command sent through it."""
+
+    def __init__(self, client, metrics):
+        """
+        Initialize.
+
+        :param client: redis-py client or ``MemoryRedis`` engine
+        :param StorageMetrics metrics: Metrics to record into
+        """
+        self._client = client
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name.startswith("_") or name in ["pipeline", "pubsub"] \
+                or not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            command = args[0] if name == "execute_command" else name
+            key = args[1] if name == "execute_command" else \
+                (args[0] if args else None)
+            if name in ["evalsha", "eval"] and len(args) > 2:
+                key = args[2]
+            elif name == "scan":
+                key = args[1] if len(args) > 1 else kwargs.get("match")
+            start = time.time()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception:
+                self._metrics.record(command, key, time.time() - start,
+                                     _size(args), 0, failed=True)
+                raise
+            self._metrics.record(command, key, time.time() - start,
+                                 _size(args), _size(result))
+            return result
+        return timed
+
+    def pipeline(self, *args, **kwargs):
+        return MeteredPipeline(self._client.pipeline(*args, **kwargs),
+                               self._metrics)
+
+
+class MeteredPipeline:
+    """Wrap a pipeline to record its size and execution time."""
+
+    def __init__(self, pipe, metrics):
+        object.__setattr__(self, "_pipe", pipe)
+        object.__setattr__(self, "_metrics", metrics)
+
+    def __getattr__(self, name):
+        return getattr(self._pipe, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._pipe, name, value)
+
+    def execute(self, *args, **kwargs):
+        commands = list(self._pipe.command_stack)
+        start = time.time()
+        results = self._pipe.execute(*args, **kwargs)
+        elapsed = time.time() - start
+        if not commands:
+            return results
+        self._metrics.record_pipeline(len(commands), elapsed)
+        # Time cannot be attributed per command, so it is split evenly
+        for (cargs, options), result in zip(commands, results):
+            self._metrics.record(
+                cargs[0], cargs[1] if len(cargs) > 1 else None,
+                elapsed / len(commands), _size(cargs[1:]), _size(result))
+        return results
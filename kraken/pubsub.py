@@ -0,0 +1,153 @@
+"""
+Classes to dispatch publish/subscribe messages to their handlers.
+
+arkOS Kraken
+(c) 2016 CitizenWeb
+Written by Jacob Cook
+Licensed under GPLv3, see LICENSE.md
+"""
+
+import eventlet
+import logging
+import time
+
+from eventlet.hubs import trampoline
+
+from kraken import serialization
+from kraken.metrics import Histogram, LATENCY_BUCKETS
+
+
+class Dispatcher:
+    """
+    Listen for publish/subscribe messages and route them by channel.
+
+    The listener parks its green thread until the subscription socket is
+    readable, then drains every pending message before waiting again, so
+    it costs nothing while idle and keeps up with bursts.
+    """
+
+    def __init__(self):
+        """Initialize."""
+        self.pubsub = None
+        self.handlers = {}
+        self.pattern_handlers = {}
+        self.stats = {"wakeups": 0, "messages": {}, "errors": 0,
+                      "max_batch": 0}
+        self.latency = Histogram(LATENCY_BUCKETS)
+
+    def on(self, channel, handler, raw=False):
+        """
+        Register a handler for messages published with ``Storage.publish``.
+
+        :param str channel: Channel name
+        :param function handler: Called with the decoded message data
+        :param bool raw: Call the handler with the tagged payload instead,
+            so it can decide whether the message needs decoding at all
+        """
+        self.handlers["arkos:{0}".format(channel).encode()] = (handler, raw)
+        if self.pubsub:
+            self.pubsub.subscribe("arkos:{0}".format(channel))
+
+    def off(self, channel):
+        """
+        Remove the handler for a channel and stop listening to it.
+
+        :param str channel: Channel name
+        """
+        self.handlers.pop("arkos:{0}".format(channel).encode(), None)
+        if self.pubsub:
+            self.pubsub.unsubscribe("arkos:{0}".format(channel))
+
+    def on_pattern(self, pattern, handler):
+        """
+        Register a handler for raw messages on channels matching a pattern.
+
+        :param str pattern: Channel name pattern
+        :param function handler: Called with the channel name and raw data
+        """
+        self.pattern_handlers[pattern.encode()] = handler
+        if self.pubsub:
+            self.pubsub.psubscribe(pattern)
+
+    def start(self, pubsub):
+        """
+        Subscribe to all registered channels and listen for messages.
+
+        Blocks the calling green thread; run it with ``eventlet.spawn``.
+
+        :param pubsub: Redis or memory engine PubSub object
+        """
+        self.pubsub = pubsub
+        if self.handlers:
+            pubsub.subscribe(*[x.decode() for x in self.handlers])
+        if self.pattern_handlers:
+            pubsub.psubscribe(*[x.decode() for x in self.pattern_handlers])
+        while True:
+            try:
+                self.drain()
+                self._wait()
+            except Exception:
+                # Lost connection; get_message() reconnects on the next try
+                logging.getLogger(__name__).exception("Listener failed")
+                eventlet.sleep(1)
+            self.stats["wakeups"] += 1
+
+    def drain(self):
+        """Dispatch all messages that are waiting to be read."""
+        count = 0
+        while True:
+            msg = self.pubsub.get_message()
+            if msg:
+                count += 1
+                self.dispatch(msg)
+            elif not self._pending():
+                break
+        self.stats["max_batch"] = max(self.stats["max_batch"], count)
+
+    def dispatch(self, msg):
+        """
+        Route a single message to its handler.
+
+        :param dict msg: Message, as returned by ``PubSub.get_message()``
+        """
+        channel = msg["channel"]
+        name = (msg["pattern"] if msg["type"] == "pmessage" else channel)
+        counts = self.stats["messages"]
+        counts[name.decode()] = counts.get(name.decode(), 0) + 1
+        try:
+            if msg["type"] == "pmessage":
+                self.pattern_handlers[msg["pattern"]](channel, msg["data"])
+            elif channel in self.handlers:
+                handler, raw = self.handlers[channel]
+                sent, data = serialization.split_message(msg["data"])
+                handler(data if raw else serialization.decode(data))
+                self.latency.observe((time.time() - sent) * 1000)
+        except Exception:
+            self.stats["errors"] += 1
+            # Not sent to the arkOS logger, which would publish it again
+            logging.getLogger(__name__).exception(
+                "Failed to handle message on %s", channel)
+
+    def get_stats(self):
+        """
+        Return listener statistics.
+
+        :returns: dict
+        """
+        return dict(self.stats, latency=self.latency.serialized())
+
+    def _connection(self):
+        return getattr(self.pubsub, "connection", None)
+
+    def _pending(self):
+        conn = self._connection()
+        return conn.can_read() if conn else self.pubsub.can_read()
+
+    def _wait(self):
+        conn = self._connection()
+        if conn and not conn._sock:
+            return
+        trampoline(conn._sock if conn else self.pubsub.fileno(), read=True)
+
+
+dispatcher = Dispatcher()
@@ -7,11 +7,172 @@ Written by Jacob Cook
 Licensed under GPLv3, see LICENSE.md
 """
 
+import eventlet
+import itertools
 import json
 
+from collections import OrderedDict
+
+from kraken.cache import LRUCache, MISSING
 from kraken.redis_storage import storage
 
 
+class PushBuffer:
+    """
+    Merge record pushes into one frame per object type.
+
+    Pushes received within a short window are collected per object type
+    and deduplicated by record ID, so only the last version of a record
+    pushed during the window is sent.
+    """
+
+    def __init__(self):
+        """Initialize."""
+        self.emit = None
+        self.window = 0
+        self.pending = OrderedDict()
+        self.stats = {"records": 0, "merged": 0, "frames": 0}
+        self._timer = None
+        self._anonymous = itertools.count()
+
+    def configure(self, emit, window=0):
+        """
+        Set how merged frames are sent.
+
+        :param function emit: Called with an object type and its records
+        :param float window: Seconds to collect pushes before sending
+        """
+        self.emit = emit
+        self.window = window
+
+    def push(self, data):
+        """
+        Queue record pushes to be sent at the end of the window.
+
+        :param dict data: Lists of serialized objects, by object type
+        """
+        for name, records in data.items():
+            bucket = self.pending.setdefault(name, OrderedDict())
+            for x in records:
+                id = x.get("id") if type(x) == dict else None
+                if id is None:
+                    id = ("anonymous", next(self._anonymous))
+                if id in bucket:
+                    del bucket[id]
+                    self.stats["merged"] += 1
+                bucket[id] = x
+                self.stats["records"] += 1
+        if self.window <= 0:
+            self.flush()
+        elif self._timer is None:
+            self._timer = eventlet.spawn_after(self.window, self.flush)
+
+    def discard(self, name, id):
+        """
+        Drop a queued push for a record, e.g. because it was purged.
+
+        :param str name: Object type
+        :param str id: Object ID
+        """
+        self.pending.get(name, {}).pop(id, None)
+
+    def flush(self):
+        """Send all queued pushes, one frame per object type."""
+        pending, self.pending = self.pending, OrderedDict()
+        self._timer = None
+        for name, bucket in pending.items():
+            if bucket:
+                self.stats["frames"] += 1
+                self.emit(name, list(bucket.values()))
+
+
+class DeltaTracker:
+    """
+    Reduce record pushes to the fields that changed since the last push.
+
+    A fingerprint of every field is kept for recently pushed records. When
+    a record is pushed again, a patch of its changed and removed fields is
+    sent instead, if it is smaller than the full record.
+    """
+
+    def __init__(self):
+        """Initialize."""
+        self.enabled = True
+        self.fingerprints = LRUCache(1024, float("inf"))
+        self.stats = {"full": 0, "patches": 0, "unchanged": 0}
+
+    def configure(self, enabled=True, size=1024):
+        """
+        Set whether patches are used and how many records are tracked.
+
+        :param bool enabled: Send patches where possible
+        :param int size: Maximum number of records to keep fingerprints for
+        """
+        self.enabled = enabled
+        self.fingerprints = LRUCache(size, float("inf"))
+
+    def split(self, name, records):
+        """
+        Sort records to push into full records and patches.
+
+        Patches have the form ``{"id": ..., "set": {...}, "unset": [...]}``.
+        Records identical to their last push are left out.
+
+        :param str name: Object type
+        :param list records: Serialized objects
+        :returns: tuple of full records and patches
+        """
+        full, patches = [], []
+        if not self.enabled:
+            return records, patches
+        for x in records:
+            id = x.get("id") if type(x) == dict else None
+            if id is None:
+                full.append(x)
+                continue
+            key = "{0}:{1}".format(name, id)
+            fields = {y: self._fingerprint(x[y]) for y in x}
+            previous = self.fingerprints.get(key)
+            self.fingerprints.set(key, fields)
+            if previous is MISSING:
+                full.append(x)
+                self.stats["full"] += 1
+                continue
+            patch = {
+                "id": id,
+                "set": {y: x[y] for y in x if previous.get(y) != fields[y]},
+                "unset": [y for y in previous if y not in fields]
+            }
+            if not patch["set"] and not patch["unset"]:
+                self.stats["unchanged"] += 1
+            elif len(json.dumps(patch)) < len(json.dumps(x)):
+                patches.append(patch)
+                self.stats["patches"] += 1
+            else:
+                full.append(x)
+                self.stats["full"] += 1
+        return full, patches
+
+    def forget(self, name, id=None):
+        """
+        Drop fingerprints, so the next push is sent in full.
+
+        :param str name: Object type
+        :param str id: Object ID; drops all records if not given
+        """
+        if id is None:
+            self.fingerprints.clear()
+        else:
+            self.fingerprints.invalidate("{0}:{1}".format(name, id))
+
+    def _fingerprint(self, value):
+        return hash(json.dumps(value, sort_keys=True, default=str))
+
+
+push_buffer = PushBuffer()
+deltas = DeltaTracker()
+
+
 def push_record(name, model):
     """
     Push an updated object record to the client.
@@ -19,7 +180,7 @@ def push_record(name, model):
     :param str name: Object type
     :param dict model: Serialized object
     """
-    storage.publish("records:push", json.dumps({name: [model]}))
+    storage.publish("records:push", {name: [model]})
 
 
 def remove_record(name, id):
@@ -29,4 +190,4 @@ def remove_record(name, id):
     :param str name: Object type
     :param str id: Object ID
     """
-    storage.publish("records:purge", json.dumps({"model": name, "id": id}))
+    storage.publish("records:purge", {"model": name, "id": id})
@@ -9,69 +9,450 @@ Licensed under GPLv3, see LICENSE.md
 
 import json
 import redis
+import threading
+import time
+
+from functools import wraps
 
 from arkos import config, secrets
 from arkos.utilities.errors import ConnectionError
 
+from kraken import serialization
+from kraken.cache import LRUCache, MISSING
+from kraken.memory_storage import MemoryRedis
+from kraken.metrics import MeteredClient, StorageMetrics
+
+RETRY_ATTEMPTS = 3
+"""Number of times a failed command is retried after a connection loss."""
+
+RETRY_BACKOFF = 0.05
+"""Initial delay (in seconds) before retrying, doubled on each attempt."""
+
+ZADD_MAPPING = getattr(redis, "VERSION", (2,)) >= (3,)
+"""True if redis-py takes ZADD members as a mapping of member to score."""
+
+STORAGE_VERSION = 2
+"""Version of the storage format; data from other versions is discarded."""
+
+READ_COMMANDS = ("GET", "HGET", "HGETALL", "LINDEX", "LRANGE", "EXISTS",
+                 "ZRANGEBYSCORE", "ZREVRANGEBYSCORE")
+"""Commands that never modify a key, and so never invalidate the cache."""
+
+IDEMPOTENT_COMMANDS = READ_COMMANDS + (
+    "TTL", "SET", "HSET", "HMSET", "HDEL", "DEL", "EXPIRE", "LREM", "ZADD",
+    "ZREM", "ZREMRANGEBYSCORE")
+"""Commands that have the same effect when sent twice, and can be retried."""
+
+REMOVE_ALL_SCRIPT = """
+local drop = {}
+for i = 1, #ARGV do
+    drop[ARGV[i]] = true
+end
+local values = redis.call("LRANGE", KEYS[1], 0, -1)
+local keep = {}
+for i = 1, #values do
+    if not drop[values[i]] then
+        keep[#keep + 1] = values[i]
+    end
+end
+local removed = #values - #keep
+if removed > 0 then
+    redis.call("DEL", KEYS[1])
+    for i = 1, #keep, 1000 do
+        redis.call("RPUSH", KEYS[1], unpack(keep, i, math.min(i + 999, #keep)))
+    end
+end
+return removed
+"""
+"""Lua script to remove a set of values from a list in one pass."""
+
+REPLACE_LIST_SCRIPT = """
+redis.call("DEL", KEYS[1])
+for i = 1, #ARGV, 1000 do
+    redis.call("RPUSH", KEYS[1], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+end
+return #ARGV
+"""
+"""Lua script to replace the contents of a list."""
+
+PUBLISH_PREPEND_SCRIPT = """
+redis.call("PUBLISH", ARGV[1], ARGV[2])
+redis.call("LPUSH", KEYS[1], ARGV[3])
+if tonumber(ARGV[4]) > 0 then
+    redis.call("EXPIRE", KEYS[1], ARGV[4])
+end
+return 1
+"""
+"""Lua script to publish a value and prepend it to a list."""
+
+REFRESH_LOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if tonumber(ARGV[2]) > 0 then
+    return redis.call("EXPIRE", KEYS[1], ARGV[2])
+end
+return redis.call("DEL", KEYS[1])
+"""
+"""Lua script to extend or release a lock, if held by the given owner."""
+
+SCRIPTS = {
+    "remove_all": REMOVE_ALL_SCRIPT,
+    "replace_list": REPLACE_LIST_SCRIPT,
+    "publish_prepend": PUBLISH_PREPEND_SCRIPT,
+    "refresh_lock": REFRESH_LOCK_SCRIPT
+}
+"""Lua scripts loaded into Redis at connect time, by name."""
+
+
+class PoolExhaustedError(redis.exceptions.ConnectionError):
+    """Raised when no pooled connection was released within the timeout."""
+
+
+def _written_keys(args):
+    name = str(args[0]).upper()
+    if name in ("EVAL", "EVALSHA"):
+        names = args[3:3 + int(args[2])]
+    elif name not in READ_COMMANDS and len(args) > 1:
+        names = args[1:2]
+    else:
+        names = []
+    return [x for x in names
+            if type(x) == str and x.startswith("arkos:")]
+
+
+def reconnecting(func=None, idempotent=True):
+    """
+    Retry a storage operation if the connection to Redis was lost.
+
+    redis-py discards a connection that failed, so each retry gets a fresh
+    one from the pool, while connections in use elsewhere (by job threads
+    or the pub/sub listener) are left alone. Retries are made with a
+    bounded exponential backoff between attempts.
+
+    Operations that must not run twice, because their first attempt may
+    have reached the server (e.g. LPUSH or PUBLISH), are marked with
+    ``idempotent=False`` and fail at once. Nested storage calls are only
+    retried by the outermost one, and not at all if any of them is not
+    idempotent.
+
+    Running out of pooled connections is not a connection loss: the
+    ``PoolExhaustedError`` is raised as-is, as retrying would only add to
+    the load that exhausted the pool.
+    """
+    if func is None:
+        return lambda x: reconnecting(x, idempotent)
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        local = self._local
+        if getattr(local, "active", False):
+            local.unsafe = local.unsafe or not idempotent
+            return func(self, *args, **kwargs)
+        local.active, local.unsafe = True, not idempotent
+        attempt = 0
+        try:
+            while True:
+                try:
+                    result = func(self, *args, **kwargs)
+                except PoolExhaustedError:
+                    raise
+                except (redis.exceptions.ConnectionError,
+                        redis.exceptions.TimeoutError):
+                    self.healthy = False
+                    attempt += 1
+                    if local.unsafe or attempt > RETRY_ATTEMPTS:
+                        raise ConnectionError("arkOS Redis")
+                    self.stats["retries"] += 1
+                    time.sleep(RETRY_BACKOFF * (2 ** (attempt - 1)))
+                    local.unsafe = not idempotent
+                else:
+                    self.healthy = True
+                    return result
+        finally:
+            local.active = False
+    return wrapper
+
+
+class MeteredConnectionPool(redis.BlockingConnectionPool):
+    """
+    A bounded connection pool that records how saturated it gets.
+
+    Once all connections are in use, callers wait for one to be released,
+    up to the pool timeout, instead of opening new connections.
+    """
+
+    def reset(self):
+        super().reset()
+        self.stats = {"waits": 0, "wait_time": 0.0, "timeouts": 0}
+
+    def get_connection(self, *args, **kwargs):
+        # redis-py 5.3+ no longer passes the command name
+        start = time.time()
+        # Otherwise an idle connection (or a free slot for a new one) is
+        # available at once, however long connecting takes
+        waiting = self.pool.empty()
+        try:
+            connection = super().get_connection(*args, **kwargs)
+        except redis.exceptions.ConnectionError as e:
+            if str(e) != "No connection available.":
+                raise
+            self.stats["timeouts"] += 1
+            raise PoolExhaustedError(str(e))
+        if waiting:
+            self.stats["waits"] += 1
+            self.stats["wait_time"] += time.time() - start
+        return connection
+
+    def get_stats(self):
+        """
+        Return pool usage statistics.
+
+        :returns: dict
+        """
+        idle = len([x for x in list(self.pool.queue) if x is not None])
+        return dict(self.stats, max_connections=self.max_connections,
+                    created=len(self._connections),
+                    in_use=len(self._connections) - idle)
+
 
 class Storage:
-    """Manage connection and interface with Redis."""
+    """
+    Manage connection and interface with Redis.
+
+    The client in ``self.redis`` is either a redis-py client or an
+    in-process ``MemoryRedis`` engine offering the same interface.
+    """
+
+    def __init__(self):
+        """Initialize."""
+        self.redis = None
+        self.codec = serialization.JSONCodec()
+        self.cache = None
+        self.scripts = dict(SCRIPTS)
+        self._shas = {}
+        self.healthy = False
+        self.stats = {"reconnects": 0, "retries": 0, "roundtrips_saved": 0}
+        self.metrics = StorageMetrics()
+        self._local = threading.local()
 
     def connect(self):
-        """Connect to Redis server."""
-        try:
-            self.redis = redis.Redis(
-                db=config.get("genesis", "redis_db", 0),
+        """
+        Connect to the storage backend selected in configuration.
+
+        This is a Redis server by default. The ``memory`` backend keeps all
+        data in process instead, for single-node installs.
+        """
+        self.cache = None
+        memory = config.get("genesis", "storage_backend", "redis") == "memory"
+        if memory:
+            self.redis = MemoryRedis(self.scripts)
+        else:
+            self.redis = self._connect_redis()
+        if config.get("genesis", "redis_metrics", True):
+            self.redis = MeteredClient(self.redis, self.metrics)
+        self.codec = serialization.get_codec(
+            config.get("genesis", "redis_codec", "json"))
+        self.load_scripts()
+        if config.get("genesis", "redis_warm_restart", True):
+            self.reconcile()
+        else:
+            self.redis.flushdb()
+        cache_size = config.get("genesis", "redis_cache_size", 512)
+        if cache_size and not memory:
+            self.cache = LRUCache(
+                cache_size, config.get("genesis", "redis_cache_ttl", 5))
+            try:
+                self.redis.config_set("notify-keyspace-events", "Kg$lhzxe")
+            except redis.exceptions.ResponseError:
+                # CONFIG may be disabled; without notifications, writes by
+                # other processes would go unseen, so don't cache at all
+                self.cache = None
+        self.healthy = True
+
+    def _connect_redis(self):
+        options = {
+            "db": config.get("genesis", "redis_db", 0),
+            "password": secrets.get("redis"),
+            "socket_timeout": config.get("genesis", "redis_timeout", None)
+        }
+        path = config.get("genesis", "redis_socket", None)
+        if path:
+            options.update(connection_class=redis.UnixDomainSocketConnection,
+                           path=path)
+        else:
+            options.update(
+                host=config.get("genesis", "redis_host", "localhost"),
                 port=config.get("genesis", "redis_port", 6380),
-                password=secrets.get("redis")
+                socket_connect_timeout=config.get(
+                    "genesis", "redis_connect_timeout", None),
+                socket_keepalive=config.get("genesis", "redis_keepalive", True)
             )
-            self.redis.ping()
-            self.redis.flushdb()
+        pool = MeteredConnectionPool(
+            max_connections=config.get("genesis", "redis_max_connections", 20),
+            timeout=config.get("genesis", "redis_pool_timeout", 20),
+            **options
+        )
+        try:
+            client = redis.Redis(connection_pool=pool)
+            client.ping()
         except redis.exceptions.ConnectionError:
             raise ConnectionError("arkOS Redis")
+        return client
 
     def disconnect(self):
         """Disconnect from Redis server."""
-        self.redis.flushdb()
+        if not config.get("genesis", "redis_warm_restart", True):
+            self.redis.flushdb()
+        self.redis.connection_pool.disconnect()
+        self.healthy = False
+
+    def reconcile(self):
+        """
+        Drop stale data left over from a previous run, keeping the rest.
+
+        If the data was written in a different storage format version, the
+        database is cleared entirely. Otherwise, job statuses and
+        notification threads that will still expire on their own are kept,
+        so clients can resume without a full resync; jobs that were still
+        running when Kraken stopped are dropped, along with everything else.
+        Job descriptors and their index are always kept, for
+        ``kraken.jobs.recover_jobs()``.
+        """
+        if self.get("version") != STORAGE_VERSION:
+            self.redis.flushdb()
+            self.set("version", STORAGE_VERSION)
+            return
+        for batch in self.scan_batches("*"):
+            names = [x.split("arkos:", 1)[1] for x in batch]
+            pipe = self.pipeline()
+            for x in names:
+                pipe.ttl("arkos:{0}".format(x))
+                if x.startswith("job:"):
+                    pipe.get("arkos:{0}".format(x))
+            results = iter(self.execute(pipe))
+            stale = []
+            for x in names:
+                ttl = next(results)
+                value = next(results) if x.startswith("job:") else None
+                if not self._is_current(x, ttl, value):
+                    stale.append("arkos:{0}".format(x))
+            if stale:
+                self.redis.delete(*stale)
+
+    def _is_current(self, key, ttl, value):
+        if key in ["version", "jobindex"] or key.startswith("jobs:"):
+            return True
+        elif ttl is None or ttl <= 0:
+            return False
+        elif key.startswith("job:"):
+            return value != 200
+        return key.startswith("n:")
+
+    def reconnect(self):
+        """
+        Drop all pooled connections so that new ones are opened lazily.
+
+        Unlike ``connect()``, the database is left untouched. Only call this
+        when no connection is in use, e.g. in a newly forked process.
+        """
         self.redis.connection_pool.disconnect()
+        if self.cache is not None:
+            self.cache.clear()
+        self.stats["reconnects"] += 1
+        self.healthy = True
+
+    def watch_keyspace(self, dispatcher):
+        """
+        Listen for keyspace notifications used to invalidate the cache.
+
+        :param Dispatcher dispatcher: Publish/subscribe message dispatcher
+        """
+        if self.cache is not None:
+            dispatcher.on_pattern("__keyspace@{0}__:arkos:*".format(
+                config.get("genesis", "redis_db", 0)), self.invalidate_event)
+
+    def invalidate_event(self, channel, data=None):
+        """
+        Invalidate a cached key from a keyspace notification.
+
+        :param bytes channel: Keyspace notification channel
+        :param bytes data: Name of the event that modified the key
+        """
+        if self.cache is not None:
+            self.cache.invalidate(channel.decode().split(":arkos:", 1)[1])
+
+    def get_stats(self):
+        """
+        Return connection, pool, cache and per-command statistics.
+
+        :returns: dict
+        """
+        data = {"connection": dict(self.stats),
+                "pool": self.redis.connection_pool.get_stats()}
+        if self.cache is not None:
+            data["cache"] = dict(self.cache.stats, size=len(self.cache))
+        data.update(self.metrics.serialized())
+        return data
+
+    def dump_stats(self, path=None):
+        """
+        Write all statistics to a JSON file, e.g. at shutdown.
+
+        :param str path: File path; defaults to ``genesis.metrics_file``
+        """
+        path = path or config.get("genesis", "metrics_file", None)
+        if not path or not self.redis:
+            return
+        with open(path, "w") as f:
+            json.dump(self.get_stats(), f, indent=2, sort_keys=True)
 
     def check(self):
         """
         Make sure our connection to Redis is still active.
 
-        If not, stop everything, reconnect and reload.
+        Connection loss is detected when a command actually fails, and only
+        the failed connection is replaced (see ``reconnecting``), so this no
+        longer costs a PING round trip per operation.
         """
-        try:
-            self.redis.ping()
-        except:
-            self.connect()
+        self.stats["roundtrips_saved"] += 1
 
-    def get(self, key, optkey=None):
+    @reconnecting
+    def get(self, key, optkey=None, pipe=None):
         """
         Get a value from a Redis key or hash.
 
         :param str key: Key name
         :param str optkey: Hash key name (optional)
+        :param pipe: Pipe to queue operations on
         """
         self.check()
+        if self.cache is not None and not pipe:
+            value = self.cache.get(key, ("get", optkey))
+            if value is not MISSING:
+                return self._get(value)
+        r = pipe or self.redis
         if optkey:
-            return self._get(self.redis.hget("arkos:{0}".format(key), optkey))
+            value = r.hget("arkos:{0}".format(key), optkey)
         else:
-            return self._get(self.redis.get("arkos:{0}".format(key)))
+            value = r.get("arkos:{0}".format(key))
+        if self.cache is not None and not pipe:
+            self.cache.set(key, value, ("get", optkey))
+        return self._get(value)
 
-    def get_all(self, key):
+    @reconnecting
+    def get_all(self, key, pipe=None):
         """
         Get all keys and values from a hash.
 
         :param str key: Key name
+        :param pipe: Pipe to queue operations on
         """
-        data = {}
-        values = self.redis.hgetall("arkos:{0}".format(key))
-        for x in list(values):
-            data[x.decode()] = self._get(values[x])
-        return data
+        r = pipe or self.redis
+        return self._get(r.hgetall("arkos:{0}".format(key)))
 
-    def set(self, key, value, optval=None, pipe=None):
+    @reconnecting
+    def set(self, key, value, optval=None, pipe=None, expiry=None):
         """
         Set a key value or hash value, or push to a list.
 
@@ -79,24 +460,69 @@ class Storage:
         :param value: Hash key name OR value to set/push to key
         :param optval: Hash key value (optional)
         :param pipe: Pipe to queue operations on
+        :param int expiry: Time in seconds until a key value expires
         """
         self.check()
         r = pipe or self.redis
         if optval:
-            r.hset("arkos:{0}".format(key), value, optval)
+            r.hset("arkos:{0}".format(key), value, self._put(optval))
         elif type(value) == list:
-            for x in enumerate(value):
-                if type(x[1]) in [list, dict]:
-                    value[x[0]] = json.dumps(x[1])
-            r.rpush("arkos:{0}".format(key), *value)
+            self.append_all(key, value, pipe=pipe)
+            return
         elif type(value) == dict:
-            for x in value:
-                if type(value[x]) in [list, dict]:
-                    value[x] = json.dumps(value[x])
-            r.hmset("arkos:{0}".format(key), value)
+            r.hmset("arkos:{0}".format(key),
+                    {x: self._put(value[x]) for x in value})
         else:
-            r.set("arkos:{0}".format(key), value)
+            r.set("arkos:{0}".format(key), self._put(value), ex=expiry)
+        self._invalidate(key, pipe)
+
+    def load_scripts(self):
+        """Load all registered Lua scripts into Redis."""
+        for name, source in self.scripts.items():
+            self._shas[name] = self.redis.script_load(source)
+
+    def register_script(self, name, source):
+        """
+        Register a Lua script to be called by name with ``run_script()``.
 
+        :param str name: Script name
+        :param str source: Lua source code
+        """
+        self.scripts[name] = source
+        if self.redis:
+            self._shas[name] = self.redis.script_load(source)
+
+    @reconnecting
+    def run_script(self, name, keys=[], args=[], pipe=None):
+        """
+        Run a registered Lua script.
+
+        Scripts are called by SHA, and transparently reloaded if Redis no
+        longer has them (e.g. after a server restart). When queued on a
+        pipe, the full source is sent instead, as a missing script could
+        not be retried within a transaction.
+
+        :param str name: Script name
+        :param list keys: Key names the script operates on
+        :param list args: Additional arguments to pass to the script
+        :param pipe: Pipe to queue operations on
+        :returns: Script result
+        """
+        names = ["arkos:{0}".format(x) for x in keys]
+        if pipe:
+            return pipe.eval(self.scripts[name], len(names), *(names + args))
+        try:
+            result = self.redis.evalsha(
+                self._shas[name], len(names), *(names + args))
+        except redis.exceptions.NoScriptError:
+            self._shas[name] = self.redis.script_load(self.scripts[name])
+            result = self.redis.evalsha(
+                self._shas[name], len(names), *(names + args))
+        for x in keys:
+            self._invalidate(x)
+        return result
+
+    @reconnecting(idempotent=False)
     def pop(self, key, pipe=None):
         """
         Remove and return a value from a list.
@@ -106,8 +532,11 @@ class Storage:
         :returns: List value
         """
         r = pipe or self.redis
-        return self._get(r.lpop("arkos:{0}".format(key)))
+        value = r.lpop("arkos:{0}".format(key))
+        self._invalidate(key, pipe)
+        return self._get(value)
 
+    @reconnecting
     def lindex(self, key, index, pipe=None):
         """
         Return a value from a list, given a specified index.
@@ -117,9 +546,61 @@ class Storage:
         :param pipe: Pipe to queue operations on
         :returns: List value
         """
+        if self.cache is not None and not pipe:
+            value = self.cache.get(key, ("lindex", index))
+            if value is not MISSING:
+                return self._get(value)
         r = pipe or self.redis
-        return self._get(r.lindex("arkos:{0}".format(key), index))
+        value = r.lindex("arkos:{0}".format(key), index)
+        if self.cache is not None and not pipe:
+            self.cache.set(key, value, ("lindex", index))
+        return self._get(value)
+
+    @reconnecting
+    def get_all_many(self, keys):
+        """
+        Get all keys and values from each of several hashes.
+
+        All lookups are sent in a single pipeline round trip.
 
+        :param list keys: Key names
+        :returns: Hash contents, in the order of ``keys``
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for x in keys:
+            pipe.hgetall("arkos:{0}".format(x))
+        return [{y.decode(): self._get(z) for y, z in x.items()}
+                for x in pipe.execute()]
+
+    @reconnecting
+    def lindex_all(self, keys, index=0):
+        """
+        Return a value at a specified index from each of several lists.
+
+        All lookups are sent in a single pipeline round trip.
+
+        :param list keys: Key names
+        :param int index: List index
+        :returns: List values, in the order of ``keys``
+        """
+        values = {}
+        if self.cache is not None:
+            for x in keys:
+                value = self.cache.get(x, ("lindex", index))
+                if value is not MISSING:
+                    values[x] = value
+        misses = [x for x in keys if x not in values]
+        if misses:
+            pipe = self.redis.pipeline(transaction=False)
+            for x in misses:
+                pipe.lindex("arkos:{0}".format(x), index)
+            for x, value in zip(misses, pipe.execute()):
+                values[x] = value
+                if self.cache is not None:
+                    self.cache.set(x, value, ("lindex", index))
+        return [self._get(values[x]) for x in keys]
+
+    @reconnecting
     def get_list(self, key):
         """
         Return an entire list.
@@ -133,6 +614,7 @@ class Storage:
             values.append(self._get(x))
         return values
 
+    @reconnecting(idempotent=False)
     def prepend(self, key, value, pipe=None):
         """
         Prepend a value to a list.
@@ -143,10 +625,10 @@ class Storage:
         """
         self.check()
         r = pipe or self.redis
-        if type(value) in [list, dict]:
-            value = json.dumps(value)
-        r.lpush("arkos:{0}".format(key), value)
+        r.lpush("arkos:{0}".format(key), self._put(value))
+        self._invalidate(key, pipe)
 
+    @reconnecting(idempotent=False)
     def append(self, key, value, pipe=None):
         """
         Append a value to a list.
@@ -157,10 +639,10 @@ class Storage:
         """
         self.check()
         r = pipe or self.redis
-        if type(value) in [list, dict]:
-            value = json.dumps(value)
-        r.rpush("arkos:{0}".format(key), value)
+        r.rpush("arkos:{0}".format(key), self._put(value))
+        self._invalidate(key, pipe)
 
+    @reconnecting(idempotent=False)
     def append_all(self, key, values, pipe=None):
         """
         Append multiple values to a list.
@@ -172,14 +654,12 @@ class Storage:
         if values:
             r = pipe or self.redis.pipeline()
             self.check()
-            values = list(values)
-            for x in enumerate(values):
-                if type(x[1]) in [list, dict]:
-                    values[x[0]] = json.dumps(x[1])
-            r.rpush("arkos:{0}".format(key), *values)
+            r.rpush("arkos:{0}".format(key), *[self._put(x) for x in values])
             if not pipe:
                 r.execute()
+            self._invalidate(key, pipe)
 
+    @reconnecting
     def set_list(self, key, values, pipe=None):
         """
         Set a Redis list to match the provided list.
@@ -189,12 +669,88 @@ class Storage:
         :param pipe: Pipe to queue operations on
         """
         if values:
-            r = pipe or self.redis.pipeline()
-            r.delete("arkos:{0}".format(key))
-            self.append_all(key, values, pipe=r)
-            if not pipe:
-                r.execute()
+            self.check()
+            self.run_script("replace_list", [key],
+                            [self._put(x) for x in values], pipe=pipe)
+
+    @reconnecting(idempotent=False)
+    def publish_prepend(self, channel, key, value, expiry=0):
+        """
+        Publish a value to a channel and prepend it to a list, atomically.
+
+        :param str channel: Channel name to publish to
+        :param str key: Key name of the list
+        :param value: Value to publish and push to list
+        :param int expiry: Time in seconds until the list expires (optional)
+        """
+        self.check()
+        self.run_script("publish_prepend", [key],
+                        ["arkos:{0}".format(channel),
+                         serialization.encode_message(value, self.codec),
+                         self._put(value), expiry])
+
+    @reconnecting(idempotent=False)
+    def claim(self, key, value, expiry=None):
+        """
+        Set a key value, unless the key is already set.
+
+        :param str key: Key name
+        :param value: Value to set
+        :param int expiry: Time in seconds until the key value expires
+        :returns: The value already set, or None if ``value`` was set
+        """
+        self.check()
+        while True:
+            if self.redis.set("arkos:{0}".format(key), self._put(value),
+                              ex=expiry, nx=True):
+                self._invalidate(key)
+                return None
+            existing = self._get(self.redis.get("arkos:{0}".format(key)))
+            # Otherwise the key expired in between; try again
+            if existing is not None:
+                return existing
+
+    @reconnecting(idempotent=False)
+    def acquire_lock(self, name, owner, ttl):
+        """
+        Take a lock, unless it is already held.
+
+        :param str name: Lock name
+        :param str owner: Unique name of the process taking the lock
+        :param int ttl: Time in seconds until the lock lapses
+        :returns: True if the lock was taken
+        """
+        self.check()
+        taken = self.redis.set("arkos:lock:{0}".format(name),
+                               self._put(owner), ex=ttl, nx=True)
+        self._invalidate("lock:{0}".format(name))
+        return bool(taken)
+
+    def renew_lock(self, name, owner, ttl):
+        """
+        Extend a lock held by the given owner.
 
+        :param str name: Lock name
+        :param str owner: Unique name of the process holding the lock
+        :param int ttl: Time in seconds until the lock lapses
+        :returns: True if the lock is still held
+        """
+        self.check()
+        return bool(self.run_script("refresh_lock", ["lock:{0}".format(name)],
+                                    [self._put(owner), ttl]))
+
+    def release_lock(self, name, owner):
+        """
+        Release a lock held by the given owner.
+
+        :param str name: Lock name
+        :param str owner: Unique name of the process holding the lock
+        """
+        self.check()
+        self.run_script("refresh_lock", ["lock:{0}".format(name)],
+                        [self._put(owner), 0])
+
+    @reconnecting
     def sortlist_add(self, key, priority, value, pipe=None):
         """
         Add a value to a sorted list.
@@ -206,10 +762,13 @@ class Storage:
         """
         self.check()
         r = pipe or self.redis
-        if type(value) in [list, dict]:
-            value = json.dumps(value)
-        r.zadd("arkos:{0}".format(key), value, priority)
+        if ZADD_MAPPING:
+            r.zadd("arkos:{0}".format(key), {self._put(value): priority})
+        else:
+            r.zadd("arkos:{0}".format(key), self._put(value), priority)
+        self._invalidate(key, pipe)
 
+    @reconnecting(idempotent=False)
     def sortlist_getbyscore(self, key, priority, num=0, pop=False):
         """
         Retrieve values from a sorted list by priority.
@@ -225,44 +784,92 @@ class Storage:
                                            num)
         if pop:
             self.redis.zremrangebyscore("arkos:{0}".format(key), num, priority)
+            self._invalidate(key)
         return self._get(data)
 
+    @reconnecting
+    def sortlist_range(self, key, min="-inf", max="+inf", start=None,
+                       num=None, reverse=False):
+        """
+        Retrieve values and their priorities from a sorted list.
+
+        Bounds are inclusive, unless prefixed with ``(``.
+
+        :param str key: Key name
+        :param min: Lowest priority to return
+        :param max: Highest priority to return
+        :param int start: Number of matching values to skip
+        :param int num: Max number of values to return
+        :param bool reverse: Return values by descending priority
+        :returns: list of tuples of value and priority
+        """
+        self.check()
+        if reverse:
+            data = self.redis.zrevrangebyscore(
+                "arkos:{0}".format(key), max, min, start=start, num=num,
+                withscores=True)
+        else:
+            data = self.redis.zrangebyscore(
+                "arkos:{0}".format(key), min, max, start=start, num=num,
+                withscores=True)
+        return [(self._get(x), y) for x, y in data]
+
+    @reconnecting
+    def sortlist_remove(self, key, values, pipe=None):
+        """
+        Remove values from a sorted list.
+
+        :param str key: Key name
+        :param list values: Values to remove
+        :param pipe: Pipe to queue operations on
+        """
+        self.check()
+        r = pipe or self.redis
+        if values:
+            r.zrem("arkos:{0}".format(key), *[self._put(x) for x in values])
+            self._invalidate(key, pipe)
+
+    @reconnecting
     def remove(self, key, value, pipe=None):
         """
-        Remove value from list.
+        Remove all occurrences of a value from a list.
+
+        Values are matched by their serialized form, which is canonical for
+        equal values (see ``kraken.serialization.Codec``).
 
         :param str key: Key name
-        :param str value: Value to remove from list
-        :returns: Sorted list values
+        :param value: Value to remove from list
+        :param pipe: Pipe to queue operations on
+        :returns: Number of values removed
         """
+        self.check()
         r = pipe or self.redis
-        newvals = []
-        for x in self.get_list(key):
-            x = self._get(x)
-            if x == value:
-                continue
-            newvals.append(x)
-        self.delete(key, pipe=r)
-        self.append_all(newvals, pipe=r)
+        # Issued raw, as redis-py versions disagree on LREM argument order
+        removed = r.execute_command("LREM", "arkos:{0}".format(key), 0,
+                                    self._put(value))
+        self._invalidate(key, pipe)
+        return removed
 
+    @reconnecting
     def remove_all(self, key, values, pipe=None):
         """
-        Remove multple values from list.
+        Remove all occurrences of multiple values from a list.
+
+        Runs as a single server-side script, so the list is filtered
+        atomically without transferring it to the client.
 
         :param str key: Key name
-        :param str values: Values to remove from list
-        :returns: Sorted list values
+        :param list values: Values to remove from list
+        :param pipe: Pipe to queue operations on
+        :returns: Number of values removed
         """
-        r = pipe or self.redis
-        newvals = []
-        for x in self.get_list(key):
-            x = self._get(x)
-            if x in values:
-                continue
-            newvals.append(x)
-        self.delete(key, pipe=r)
-        self.append_all(newvals, pipe=r)
+        if not values:
+            return 0
+        self.check()
+        return self.run_script("remove_all", [key],
+                               [self._put(x) for x in values], pipe=pipe)
 
+    @reconnecting
     def delete(self, key, pipe=None):
         """
         Delete key.
@@ -273,41 +880,109 @@ class Storage:
         self.check()
         r = pipe or self.redis
         r.delete("arkos:{0}".format(key))
+        self._invalidate(key, pipe)
 
-    def scan(self, key):
+    def scan(self, key, count=None):
         """
         Get a list of keys present that match the provided pattern.
 
         :param str key: Key name pattern
+        :param int count: Number of keys to examine per SCAN call (hint)
         :returns: List of key names
         """
-        data = self.redis.scan(0, "arkos:{0}".format(key))[1]
-        return [x.decode() for x in data]
+        return list(self.scan_iter(key, count))
 
+    def scan_iter(self, key, count=None):
+        """
+        Iterate over all keys that match the provided pattern.
+
+        The full SCAN cursor is followed, one page at a time, so keys are
+        yielded as they arrive instead of being collected into a list.
+
+        :param str key: Key name pattern
+        :param int count: Number of keys to examine per SCAN call (hint)
+        :returns: Generator of key names
+        """
+        count = count or config.get("genesis", "redis_scan_count", 100)
+        cursor = None
+        while cursor != 0:
+            cursor, data = self._scan_page(key, cursor or 0, count)
+            for x in data:
+                yield x.decode()
+
+    def scan_batches(self, key, size=100, count=None):
+        """
+        Iterate over all keys that match the provided pattern, in batches.
+
+        :param str key: Key name pattern
+        :param int size: Maximum number of key names per batch
+        :param int count: Number of keys to examine per SCAN call (hint)
+        :returns: Generator of lists of key names
+        """
+        batch = []
+        for x in self.scan_iter(key, count):
+            batch.append(x)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @reconnecting
+    def _scan_page(self, key, cursor, count):
+        return self.redis.scan(cursor, "arkos:{0}".format(key), count)
+
+    @reconnecting(idempotent=False)
     def publish(self, channel, data=None, pipe=None):
         """
         Publish data to a publish/subscribe channel.
 
+        Messages are stamped with the time they were sent, so subscribers
+        can measure delivery latency.
+
         :param str channel: Channel name to publish to
         :param value: Data to publish to the channel
+        :param pipe: Pipe to queue operations on
         """
         self.check()
         r = pipe or self.redis
-        if data:
-            if type(data) in [list, dict]:
-                data = json.dumps(data)
-            r.publish("arkos:{0}".format(channel), data)
-        else:
-            r.publish("arkos:{0}".format(channel))
+        r.publish("arkos:{0}".format(channel),
+                  serialization.encode_message(data, self.codec))
 
     def pipeline(self):
         """Create a set of Redis commands."""
         return self.redis.pipeline()
 
     def execute(self, pipe):
-        """Execute a set of commands."""
-        pipe.execute()
+        """
+        Execute a set of commands.
 
+        :param pipe: Pipe with queued operations
+        :returns: Decoded results, in the order the commands were queued
+        """
+        commands = list(pipe.command_stack)
+        if all(str(x[0][0]).upper() in IDEMPOTENT_COMMANDS
+               for x in commands):
+            results = self._execute(pipe, commands)
+        else:
+            results = self._execute_once(pipe)
+        if self.cache is not None:
+            for args, options in commands:
+                for x in _written_keys(args):
+                    self.cache.invalidate(x[6:])
+        return [self._get(x) for x in results]
+
+    @reconnecting
+    def _execute(self, pipe, commands):
+        # A failed pipeline is reset, so restore its commands before retrying
+        pipe.command_stack = list(commands)
+        return pipe.execute()
+
+    @reconnecting(idempotent=False)
+    def _execute_once(self, pipe):
+        return pipe.execute()
+
+    @reconnecting
     def expire(self, key, time, pipe=None):
         """
         Set a key's time until expiry.
@@ -319,31 +994,27 @@ class Storage:
         r = pipe or self.redis
         r.expire("arkos:{0}".format(key), time)
 
+    @reconnecting
     def exists(self, key, pipe=None):
         """Return True if a key exists."""
         r = pipe or self.redis
         return r.exists("arkos:{0}".format(key))
 
+    def _invalidate(self, key, pipe=None):
+        # Queued writes are invalidated by execute(), once they are applied
+        if self.cache is not None and not pipe:
+            self.cache.invalidate(key)
+
+    def _put(self, value):
+        return serialization.encode(value, self.codec)
+
     def _get(self, value):
-        if type(value) == bytes:
-            return self._translate(value)
-        elif type(value) == str:
-            return self._translate(value.encode("utf-8"))
-        elif type(value) == list:
-            vals = []
-            for x in value:
-                vals.append(self._translate(x))
-            return vals
-        elif value == "None":
-            return None
-        return value
-
-    def _translate(self, value):
-        if value.startswith((b"[", b"{")) and value.endswith((b"]", b"}")):
-            return json.loads(value.decode())
-        if type(value) == bytes:
-            value = value.decode()
-        return value
+        if type(value) == list:
+            return [serialization.decode(x) for x in value]
+        elif type(value) == dict:
+            return {x.decode(): serialization.decode(y)
+                    for x, y in value.items()}
+        return serialization.decode(value)
 
 
 storage = Storage()
@@ -0,0 +1,233 @@
+"""
+Codecs to serialize values kept in Redis.
+
+Every value written by Kraken is wrapped in a one-byte type tag, so reads
+dispatch on the tag instead of guessing the format from the data.
+
+arkOS Kraken
+(c) 2016 CitizenWeb
+Written by Jacob Cook
+Licensed under GPLv3, see LICENSE.md
+"""
+
+import json
+import struct
+import time
+
+from collections import OrderedDict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+STRING_TAG = b"\x00"
+JSON_TAG = b"\x01"
+MSGPACK_TAG = b"\x02"
+BYTES_TAG = b"\x03"
+
+
+class Codec:
+    """
+    Base class for a structured data serialization backend.
+
+    Serialization is canonical (mappings are written with sorted keys), so
+    equal values always serialize to the same bytes. Values can then be
+    matched by Redis itself, e.g. by LREM.
+    """
+
+    name = None
+    tag = None
+
+    def dumps(self, value):
+        """
+        Serialize a value.
+
+        :param value: Value to serialize
+        :returns: bytes
+        """
+        raise NotImplementedError
+
+    def loads(self, data):
+        """
+        Deserialize a value.
+
+        :param bytes data: Serialized value
+        :returns: Deserialized value
+        """
+        raise NotImplementedError
+
+
+def _key(key):
+    # Mapping keys become strings, as they do in JSON
+    return key if type(key) == str else json.dumps(key)
+
+
+def _sorted(value):
+    if isinstance(value, dict):
+        return OrderedDict(sorted(((_key(x), _sorted(y))
+                                   for x, y in value.items()),
+                                  key=lambda x: x[0]))
+    elif isinstance(value, (list, tuple)):
+        return [_sorted(x) for x in value]
+    return value
+
+
+class JSONCodec(Codec):
+    """Serialize data with the standard library ``json`` module."""
+
+    name = "json"
+    tag = JSON_TAG
+
+    def dumps(self, value):
+        try:
+            data = json.dumps(value, separators=(",", ":"), sort_keys=True)
+        except TypeError:
+            # Keys of mixed types can't be compared; convert them first
+            data = json.dumps(_sorted(value), separators=(",", ":"))
+        return data.encode("utf-8")
+
+    def loads(self, data):
+        return json.loads(data.decode("utf-8"))
+
+
+class OrjsonCodec(JSONCodec):
+    """Serialize data with ``orjson``. Shares its wire format with JSON."""
+
+    name = "orjson"
+
+    def dumps(self, value):
+        return orjson.dumps(
+            value, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class MsgpackCodec(Codec):
+    """Serialize data with ``msgpack``."""
+
+    name = "msgpack"
+    tag = MSGPACK_TAG
+
+    def dumps(self, value):
+        return msgpack.packb(_sorted(value), use_bin_type=True)
+
+    def loads(self, data):
+        # Values written before keys were converted may have other keys
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+CODECS = {"json": JSONCodec, "orjson": OrjsonCodec, "msgpack": MsgpackCodec}
+
+_available = {"json": True, "orjson": orjson is not None,
+              "msgpack": msgpack is not None}
+
+# Tagged data is always decoded with the fastest backend available for it
+_decoders = {JSON_TAG: OrjsonCodec() if orjson else JSONCodec()}
+if msgpack:
+    _decoders[MSGPACK_TAG] = MsgpackCodec()
+
+
+def is_available(name):
+    """
+    Return True if the backend for a codec is installed.
+
+    :param str name: Codec name (``json``, ``orjson`` or ``msgpack``)
+    :returns: bool
+    """
+    return _available.get(name, False)
+
+
+def get_codec(name):
+    """
+    Return a codec by name, falling back to stdlib JSON if unavailable.
+
+    :param str name: Codec name (``json``, ``orjson`` or ``msgpack``)
+    :returns: Codec
+    """
+    if not _available.get(name):
+        return JSONCodec()
+    return CODECS[name]()
+
+
+def encode(value, codec):
+    """
+    Serialize a value into a tagged envelope.
+
+    Strings and bytes are stored as-is behind their tag; all other values
+    are serialized by the given codec.
+
+    :param value: Value to serialize
+    :param Codec codec: Codec to use for structured values
+    :returns: bytes
+    """
+    if type(value) == str:
+        return STRING_TAG + value.encode("utf-8")
+    elif type(value) == bytes:
+        return BYTES_TAG + value
+    return codec.tag + codec.dumps(value)
+
+
+def decode(value):
+    """
+    Deserialize a tagged envelope.
+
+    Values without a known tag (e.g. written by an older Kraken) are
+    decoded the way they used to be: JSON if they look like an array or
+    object, a string otherwise.
+
+    :param value: Serialized value, as returned by Redis
+    :returns: Deserialized value
+    """
+    if type(value) == str:
+        value = value.encode("utf-8")
+    elif type(value) != bytes:
+        return value
+    tag, data = value[:1], value[1:]
+    if tag == STRING_TAG:
+        return data.decode("utf-8")
+    elif tag in _decoders:
+        return _decoders[tag].loads(data)
+    elif tag == BYTES_TAG:
+        return data
+    if value.startswith((b"[", b"{")) and value.endswith((b"]", b"}")):
+        return json.loads(value.decode())
+    return value.decode()
+
+
+def encode_message(value, codec):
+    """
+    Serialize a pub/sub message, stamped with the time it was sent.
+
+    :param value: Value to serialize
+    :param Codec codec: Codec to use for structured values
+    :returns: bytes
+    """
+    return struct.pack("!d", time.time()) + encode(value, codec)
+
+
+def split_message(message):
+    """
+    Separate the send time of a pub/sub message from its tagged payload.
+
+    :param bytes message: Message, as created by ``encode_message()``
+    :returns: tuple of send time (UNIX timestamp) and tagged payload
+    """
+    return struct.unpack("!d", message[:8])[0], message[8:]
+
+
+def decode_message(message):
+    """
+    Deserialize a pub/sub message.
+
+    :param bytes message: Message, as created by ``encode_message()``
+    :returns: tuple of send time (UNIX timestamp) and value
+    """
+    sent, data = split_message(message)
+    return sent, decode(data)
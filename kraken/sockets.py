@@ -0,0 +1,453 @@
+"""
+Classes to manage sending events to connected socket.io clients.
+
+arkOS Kraken
+(c) 2016 CitizenWeb
+Written by Jacob Cook
+Licensed under GPLv3, see LICENSE.md
+"""
+
+import eventlet
+import itertools
+
+from collections import OrderedDict
+
+from kraken import serialization
+from kraken.redis_storage import storage
+
+BROADCAST_ROOM = "all"
+"""Room for clients that have not subscribed to anything in particular."""
+
+NOTIFICATIONS_ROOM = "notifications"
+"""Room for clients that want every notification."""
+
+
+def model_room(name):
+    """
+    Return the room for clients interested in an object type.
+
+    :param str name: Object type
+    :returns: Room name
+    """
+    return "model:{0}".format(name)
+
+
+def job_room(id):
+    """
+    Return the room for clients interested in a job's notifications.
+
+    :param str id: Job ID
+    :returns: Room name
+    """
+    return "job:{0}".format(id)
+
+
+def patch_room(room):
+    """
+    Return the variant of a room for clients that apply record patches.
+
+    :param str room: Room name
+    :returns: Room name
+    """
+    return "{0}+patches".format(room)
+
+
+def binary_room(room):
+    """
+    Return the variant of a room for clients that accept msgpack events.
+
+    :param str room: Room name
+    :returns: Room name
+    """
+    return "{0}#msgpack".format(room)
+
+
+class Broadcaster:
+    """
+    Send events to the rooms of clients interested in them.
+
+    Clients start out in the broadcast room, which receives every event,
+    and leave it once they subscribe to specific object types or jobs.
+    Clients that subscribe with msgpack encoding join the binary variant
+    of each room instead, and receive event data as msgpack bytes. Only
+    clients that subscribe with patches enabled join the patch variant of
+    record rooms, and receive ``modelPatch`` events; all other clients
+    receive full records.
+
+    With several worker processes, record events are produced by one
+    worker only, and relayed through storage to every worker, which then
+    sends them to its own clients.
+    """
+
+    def __init__(self):
+        """Initialize."""
+        self.socketio = None
+        self.binary = False
+        self.relay = False
+        self.codec = None
+        self.stats = {}
+
+    def configure(self, socketio, binary=True, relay=False):
+        """
+        Set the socket.io server to send events through.
+
+        :param SocketIO socketio: Flask-SocketIO server
+        :param bool binary: Offer msgpack encoding to clients, if available
+        :param bool relay: Relay record events to all worker processes
+        """
+        self.socketio = socketio
+        self.binary = binary and serialization.is_available("msgpack")
+        self.relay = relay
+        self.codec = serialization.get_codec("msgpack")
+
+    def emit(self, event, data, rooms, payload=None, broadcast=True):
+        """
+        Send an event to the clients in the given rooms and the broadcast
+        room. Each client receives the event once, even if it is in several
+        of the rooms.
+
+        :param str event: Event name
+        :param data: Event data
+        :param list rooms: Room names
+        :param bytes payload: Event data already serialized with msgpack
+        :param bool broadcast: Also send to the broadcast room
+        """
+        rooms = list(rooms)
+        sent = set()
+        if self.binary and rooms:
+            binary = [binary_room(x) for x in rooms]
+            if any(self._participants(x) for x in binary):
+                # Serialized once, then shared by every binary client
+                if payload is None:
+                    payload = self.codec.dumps(data)
+                self._send(event, payload, binary, sent)
+        self._send(event, data,
+                   rooms + ([BROADCAST_ROOM] if broadcast else []), sent)
+
+    def publish(self, event, data, rooms, broadcast=True):
+        """
+        Send an event to clients of all worker processes.
+
+        :param str event: Event name
+        :param data: Event data
+        :param list rooms: Room names
+        :param bool broadcast: Also send to the broadcast room
+        """
+        if self.relay:
+            storage.publish("sockets:emit",
+                            {"event": event, "data": data, "rooms": rooms,
+                             "broadcast": broadcast})
+        else:
+            self.emit(event, data, rooms, broadcast=broadcast)
+
+    def relayed(self, data):
+        """
+        Send an event relayed from another worker process to our clients.
+
+        :param dict data: Event name, data and room names
+        """
+        self.emit(data["event"], data["data"], data["rooms"],
+                  broadcast=data.get("broadcast", True))
+
+    def _participants(self, room, namespace="/"):
+        manager = self.socketio.server.manager
+        return list(manager.get_participants(namespace, room)) \
+            if room in manager.rooms.get(namespace, {}) else []
+
+    def _send(self, event, data, rooms, sent, namespace="/"):
+        for room in rooms:
+            count = 0
+            for x in self._participants(room, namespace):
+                # Newer servers list each client as a tuple of socket.io
+                # and Engine.IO session IDs
+                sid = x[0] if type(x) == tuple else x
+                if sid in sent:
+                    continue
+                sent.add(sid)
+                outbound.emit(sid, event, data, namespace)
+                count += 1
+            if count:
+                self.stats[room] = self.stats.get(room, 0) + count
+
+    def push_models(self, name, records, full=None, patches=None):
+        """
+        Send new or updated records of an object type.
+
+        Clients that apply patches receive ``full`` and ``patches`` in place
+        of ``records``, if given.
+
+        :param str name: Object type
+        :param list records: Serialized objects
+        :param list full: Serialized objects to send to patching clients
+        :param list patches: Field-level patches of serialized objects
+        """
+        room = model_room(name)
+        if patches is None:
+            if records:
+                self.publish("modelPush", {name: records},
+                             [room, patch_room(room)])
+            return
+        if records:
+            self.publish("modelPush", {name: records}, [room])
+        if full:
+            self.publish("modelPush", {name: full}, [patch_room(room)],
+                         broadcast=False)
+        if patches:
+            self.publish("modelPatch", {name: patches}, [patch_room(room)],
+                         broadcast=False)
+
+    def send_progress(self, data):
+        """
+        Send a job's progress.
+
+        :param dict data: Job ID and progress, from ``progress_info()``
+        """
+        self.emit("jobProgress", data, [job_room(data["id"])])
+
+    def purge_model(self, data):
+        """
+        Send the removal of a record.
+
+        :param dict data: Object type and ID of the removed record
+        """
+        room = model_room(data["model"])
+        self.publish("modelPurge", data, [room, patch_room(room)])
+
+    def send_notification(self, message):
+        """
+        Send a notification.
+
+        A notification published as msgpack is passed on to binary clients
+        exactly as it was read from storage.
+
+        :param bytes message: Tagged notification, as published
+        """
+        data = serialization.decode(message)
+        payload = None
+        if message[:1] == serialization.MSGPACK_TAG:
+            payload = message[1:]
+        self.emit("sendNotification", data,
+                  [NOTIFICATIONS_ROOM, job_room(data["id"])], payload)
+
+
+def _apply_patch(record, patch):
+    record = dict(record)
+    record.update(patch.get("set", {}))
+    for x in patch.get("unset", []):
+        record.pop(x, None)
+    return record
+
+
+def _compose_patches(first, second):
+    fields = {x: y for x, y in first.get("set", {}).items()
+              if x not in second.get("unset", [])}
+    fields.update(second.get("set", {}))
+    unset = set(first.get("unset", [])) - set(second.get("set", {}))
+    unset.update(second.get("unset", []))
+    return {"id": second["id"], "set": fields, "unset": sorted(unset)}
+
+
+class ClientQueue:
+    """
+    Events waiting to be sent to a client that is not keeping up.
+
+    Queued notifications are merged by thread ID, and record pushes,
+    patches and purges by record ID, so that only the latest state of each
+    is sent. Past the size limit, the oldest events are dropped and the
+    client is told to refetch the object types it missed.
+    """
+
+    def __init__(self, size):
+        """
+        Initialize.
+
+        :param int size: Maximum number of events to hold
+        """
+        self.size = size
+        self.entries = OrderedDict()
+        self.resync = set()
+        self._anonymous = itertools.count()
+
+    def add(self, event, data, namespace=None, id=None):
+        """
+        Queue an event, merging it with queued events where possible.
+
+        :param str event: Event name
+        :param data: Event data
+        :param str namespace: socket.io namespace
+        :param int id: Callback ID
+        :returns: tuple of the number of events merged and dropped
+        """
+        merged = 0
+        for key, name, value in self._split(event, data, id):
+            key = (namespace,) + key
+            old = self.entries.pop(key, None)
+            if old:
+                merged += 1
+                value = self._merge(old, event, value)
+            else:
+                value = (event, name, value, namespace, id)
+            self.entries[key] = value
+        dropped = 0
+        while len(self.entries) > self.size:
+            key, (event, name, value, namespace, id) = \
+                self.entries.popitem(last=False)
+            if event not in ["sendNotification", "jobProgress"]:
+                self.resync.add(name)
+            dropped += 1
+        return merged, dropped
+
+    def frames(self):
+        """
+        Return the queued events, with record events regrouped in frames.
+
+        :returns: list of tuples of event, data, namespace and callback ID
+        """
+        frames = []
+        if self.resync:
+            models = None if None in self.resync else sorted(self.resync)
+            frames.append(("resync", {"models": models}, None, None))
+        group = None
+        for event, name, value, namespace, id in self.entries.values():
+            if event not in ["modelPush", "modelPatch"] or name is None:
+                frames.append((event, value, namespace, id))
+                group = None
+            elif group == (event, name, namespace):
+                frames[-1][1][name].append(value)
+            else:
+                frames.append((event, {name: [value]}, namespace, None))
+                group = (event, name, namespace)
+        return frames
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _split(self, event, data, id):
+        if type(data) == dict and id is None:
+            if event in ["modelPush", "modelPatch"]:
+                return [(self._record_key(name, x), name, x)
+                        for name, records in data.items() for x in records]
+            elif event == "modelPurge":
+                return [(("record", data["model"], data["id"]),
+                         data["model"], data)]
+            elif event == "sendNotification" and "id" in data:
+                return [(("n", data["id"]), None, data)]
+            elif event == "jobProgress":
+                return [(("progress", data["id"]), None, data)]
+        # Unknown events (and binary frames) are never merged
+        return [(("event", next(self._anonymous)), None, data)]
+
+    def _record_key(self, name, record):
+        id = record.get("id") if type(record) == dict else None
+        if id is None:
+            return ("event", next(self._anonymous))
+        return ("record", name, id)
+
+    def _merge(self, old, event, value):
+        old_event, name, old_value, namespace, id = old
+        if event == "modelPatch" and old_event == "modelPush":
+            return (old_event, name, _apply_patch(old_value, value),
+                    namespace, id)
+        elif event == "modelPatch" and old_event == "modelPatch":
+            return (event, name, _compose_patches(old_value, value),
+                    namespace, id)
+        return (event, name, value, namespace, id)
+
+
+class OutboundQueues:
+    """
+    Bound the number of events waiting to be sent to each client.
+
+    Events go straight to a client's Engine.IO socket while it keeps up.
+    Once too many packets are waiting on the socket, further events are
+    held in a ``ClientQueue`` and sent when the socket has drained.
+
+    Only events sent through ``emit()`` (i.e. by the ``Broadcaster``) are
+    held back; replies to a client's own requests always go straight out.
+    """
+
+    def __init__(self):
+        """Initialize."""
+        self.server = None
+        self.size = 256
+        self.depth = 16
+        self.interval = 0.05
+        self.queues = {}
+        self.stats = {"queued": 0, "merged": 0, "dropped": 0, "resyncs": 0}
+
+    def configure(self, server, size=256, depth=16):
+        """
+        Set the socket.io server to send events through.
+
+        :param Server server: python-socketio server
+        :param int size: Maximum number of events to hold per client
+        :param int depth: Packets waiting on a client socket before events
+            are held back
+        """
+        self.server = server
+        self.size = size
+        self.depth = depth
+
+    def emit(self, sid, event, data, namespace="/"):
+        """
+        Send an event to a client, or queue it if the client is behind.
+
+        :param str sid: Client session ID
+        :param str event: Event name
+        :param data: Event data
+        :param str namespace: socket.io namespace
+        """
+        queue = self.queues.get(sid)
+        if queue is None:
+            try:
+                backlog = self._backlog(sid, namespace)
+            except KeyError:
+                backlog = 0
+            if backlog < self.depth:
+                return self._send(sid, event, data, namespace)
+            queue = self.queues[sid] = ClientQueue(self.size)
+            eventlet.spawn(self._drain, sid, namespace)
+        merged, dropped = queue.add(event, data, namespace)
+        self.stats["queued"] += 1
+        self.stats["merged"] += merged
+        self.stats["dropped"] += dropped
+
+    def get_stats(self):
+        """
+        Return queue statistics, with the depth of each client's queue.
+
+        :returns: dict
+        """
+        return dict(self.stats, clients={x: len(y)
+                                         for x, y in self.queues.items()})
+
+    def _send(self, sid, event, data, namespace):
+        self.server.emit(event, data, to=sid, namespace=namespace)
+
+    def _backlog(self, sid, namespace):
+        manager = self.server.manager
+        # Since python-socketio 5, socket.io and Engine.IO session IDs differ
+        if hasattr(manager, "eio_sid_from_sid"):
+            sid = manager.eio_sid_from_sid(sid, namespace)
+        return self.server.eio.sockets[sid].queue.qsize()
+
+    def _drain(self, sid, namespace):
+        while True:
+            eventlet.sleep(self.interval)
+            try:
+                if self._backlog(sid, namespace) >= self.depth:
+                    continue
+            except KeyError:
+                # The client disconnected
+                self.queues.pop(sid, None)
+                return
+            queue = self.queues.pop(sid)
+            if queue.resync:
+                self.stats["resyncs"] += 1
+            for event, data, namespace, id in queue.frames():
+                self._send(sid, event, data, namespace or "/")
+            return
+
+
+broadcaster = Broadcaster()
+outbound = OutboundQueues()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Benchmark storage codecs on notification- and record-sized payloads.
+
+Compares the legacy read path (sniffing for JSON and decoding with
+``json.loads``) with each available codec from ``kraken.serialization``.
+Needs no Redis server.
+
+arkOS Kraken
+(c) 2016 CitizenWeb
+Written by Jacob Cook
+Licensed under GPLv3, see LICENSE.md
+"""
+
+import argparse
+import json
+import timeit
+
+from kraken import serialization
+
+NOTIFICATION = {
+    "id": "a1b2c3d4", "title": "Installing packages", "class": "info",
+    "message": "Installing nginx, php-fpm and 3 dependencies",
+    "message_id": "a1b2c3d4", "complete": False, "time": 1476800000.0,
+    "progress": {"current": 3, "total": 8, "step": "Downloading"}
+}
+"""A typical job notification."""
+
+RECORD = {
+    "id": "wordpress", "name": "WordPress", "type": "website",
+    "version": "4.6.1-1", "installed": True, "upgradable": False,
+    "description": {"short": "Open-source blogging platform",
+                    "long": "WordPress is web software you can use to "
+                            "create a beautiful website or blog. " * 8},
+    "dependencies": [{"type": "system", "name": x, "package": x}
+                     for x in ("nginx", "php", "php-fpm", "mariadb")],
+    "website_options": {"messages": {x: "Message {0}".format(x)
+                                     for x in range(20)}},
+    "screenshots": ["screen{0}.jpg".format(x) for x in range(5)],
+    "logo": "data:image/png;base64," + "A" * 2048
+}
+"""A typical application record, as sent to the client."""
+
+
+def legacy_decode(value):
+    value = value.decode()
+    if value.startswith(("[", "{")) and value.endswith(("]", "}")):
+        return json.loads(value)
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    print("Mean time per value (us), {0} iterations".format(args.number))
+    print("{0:<14} {1:<8} {2:>8} {3:>8} {4:>8}"
+          .format("payload", "codec", "size", "encode", "decode"))
+    for label, value in (("notification", NOTIFICATION), ("record", RECORD)):
+        data = json.dumps(value).encode()
+        enc = timeit.timeit(lambda: json.dumps(value).encode(),
+                            number=args.number)
+        dec = timeit.timeit(lambda: legacy_decode(data), number=args.number)
+        print("{0:<14} {1:<8} {2:>8} {3:>8.2f} {4:>8.2f}"
+              .format(label, "legacy", len(data),
+                      enc / args.number * 1e6, dec / args.number * 1e6))
+        for name in sorted(serialization.CODECS):
+            if not serialization.is_available(name):
+                continue
+            codec = serialization.get_codec(name)
+            data = serialization.encode(value, codec)
+            enc = timeit.timeit(lambda: serialization.encode(value, codec),
+                                number=args.number)
+            dec = timeit.timeit(lambda: serialization.decode(data),
+                                number=args.number)
+            print("{0:<14} {1:<8} {2:>8} {3:>8.2f} {4:>8.2f}"
+                  .format(label, name, len(data),
+                          enc / args.number * 1e6, dec / args.number * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Benchmark modelPush coalescing during a simulated package install.
+
+Pushes single-record updates at a steady rate, as ``push_record`` does,
+and counts the frames a client receives with and without a coalescing
+window. Client cost is estimated as the time spent parsing every frame.
+Needs no Redis server.
+
+arkOS Kraken
+(c) 2016 CitizenWeb
+Written by Jacob Cook
+Licensed under GPLv3, see LICENSE.md
+"""
+
+import argparse
+import eventlet
+import json
+import random
+import time
+
+from kraken.records import PushBuffer
+
+
+def updates(count, records):
+    # Installs push the same few records (packages, apps, services)
+    # repeatedly as their state changes
+    names = ("packages", "apps", "services")
+    for i in range(count):
+        id = "record{0}".format(random.randrange(records))
+        yield random.choice(names), {
+            "id": id, "state": i, "version": "1.0.{0}".format(i),
+            "description": "x" * 200
+        }
+
+
+def run(window, count, records, interval):
+    frames = []
+    buffer = PushBuffer()
+    buffer.configure(
+        lambda name, data: frames.append(json.dumps(["modelPush", {
+            "model": name, "records": data}])), window)
+    random.seed(0)
+    for name, record in updates(count, records):
+        buffer.push({name: [record]})
+        eventlet.sleep(interval)
+    eventlet.sleep(window)
+    buffer.flush()
+    start = time.perf_counter()
+    for x in frames:
+        json.loads(x)
+    parse = time.perf_counter() - start
+    return len(frames), sum(len(x) for x in frames), parse * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--pushes", type=int, default=500)
+    parser.add_argument("--records", type=int, default=40)
+    parser.add_argument("--interval", type=float, default=0.002)
+    args = parser.parse_args()
+
+    print("{0} pushes of {1} distinct records, one every {2} ms"
+          .format(args.pushes, args.records, args.interval * 1000))
+    print("{0:>10} {1:>8} {2:>10} {3:>10}"
+          .format("window", "frames", "bytes", "parse ms"))
+    for window in (0, 0.01, 0.05, 0.1, 0.25):
+        frames, size, parse = run(window, args.pushes, args.records,
+                                  args.interval)
+        print("{0:>10} {1:>8} {2:>10} {3:>10.2f}"
+              .format(window, frames, size, parse))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Benchmark list removal: client-side filtering vs LREM and the Lua script.
+
+Runs against a scratch Redis database (db 15 by default), which is
+flushed before each run.
+
+arkOS Kraken
+(c) 2016 CitizenWeb
+Written by Jacob Cook
+Licensed under GPLv3, see LICENSE.md
+"""
+
+import argparse
+import redis
+import time
+
+from kraken import serialization
+from kraken.redis_storage import REMOVE_ALL_SCRIPT
+
+KEY = "arkos:bench:remove"
+
+
+def fill(r, values):
+    r.delete(KEY)
+    for i in range(0, len(values), 1000):
+        r.rpush(KEY, *values[i:i + 1000])
+
+
+def client_side(r, drop):
+    # The original approach: fetch, filter, delete and push back
+    values = [x for x in r.lrange(KEY, 0, -1) if x not in drop]
+    pipe = r.pipeline()
+    pipe.delete(KEY)
+    for i in range(0, len(values), 1000):
+        pipe.rpush(KEY, *values[i:i + 1000])
+    pipe.execute()
+
+
+def lrem(r, drop):
+    pipe = r.pipeline()
+    for x in drop:
+        pipe.lrem(KEY, 0, x)
+    pipe.execute()
+
+
+def timed(r, values, func, drop, rounds):
+    total = 0
+    for _ in range(rounds):
+        fill(r, values)
+        start = time.perf_counter()
+        func(r, drop)
+        total += time.perf_counter() - start
+    return total / rounds * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--db", type=int, default=15)
+    parser.add_argument("--size", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    r = redis.StrictRedis(host=args.host, port=args.port, db=args.db)
+    r.flushdb()
+    script = r.register_script(REMOVE_ALL_SCRIPT)
+    codec = serialization.get_codec("json")
+    values = [serialization.encode({"id": i, "name": "item{0}".format(i)},
+                                   codec) for i in range(args.size)]
+
+    def lua(r, drop):
+        script(keys=[KEY], args=list(drop))
+
+    print("List of {0} values, mean of {1} rounds (ms)"
+          .format(args.size, args.rounds))
+    print("{0:>8} {1:>12} {2:>12} {3:>12}"
+          .format("removed", "client", "lrem", "script"))
+    for count in (1, 10, 100, 1000):
+        drop = set(values[::args.size // count][:count])
+        results = [timed(r, values, x, drop, args.rounds)
+                   for x in (client_side, lrem, lua)]
+        print("{0:>8} {1:>12.2f} {2:>12.2f} {3:>12.2f}"
+              .format(count, *results))
+    r.flushdb()
+
+
+if __name__ == "__main__":
+    main()
@@ -11,11 +11,17 @@ install_requires = [
     'redis'
 ]
 
+extras_require = {
+    'orjson': ['orjson'],
+    'msgpack': ['msgpack>=0.6.1']
+}
+
 
 setup(
     name='arkos-kraken',
     version='0.8.3',
     install_requires=install_requires,
+    extras_require=extras_require,
     description='arkOS REST API',
     author='CitizenWeb',
     author_email='jacob@citizenweb.io',